@@ -0,0 +1,674 @@
+# Benchmark harness that loads synthetic ACS and TIGER data into a
+# throwaway postgres database and reports the throughput of each phase
+
+import csv
+import hashlib
+import json
+import os
+import random
+import resource
+import sys
+import threading
+import time
+from argparse import ArgumentParser
+from cStringIO import StringIO
+from collections import OrderedDict
+from glob import glob
+from math import cos, pi, sin
+from os.path import dirname, exists, join
+from zipfile import ZipFile, ZIP_DEFLATED
+
+import fiona
+from appdirs import user_cache_dir
+from fiona.crs import from_epsg
+from shapely.geometry import mapping, Polygon
+from sqlalchemy import create_engine, MetaData
+
+import censuspgsql.parquet as parquet
+import censuspgsql.postgis_tiger as tiger
+import censuspgsql.postgres_acs as acs
+import censuspgsql.utilities as utils
+from censuspgsql.utilities import ACS_MOD, ACS_SCHEMA, PG_URL, TIGER_MOD
+
+BENCHMARK_DIR = join(user_cache_dir(__package__), 'benchmark')
+BENCHMARK_YEAR = 2099
+GEO_TEMPLATE = [
+    ('FILEID', 'File Identification'),
+    ('STUSAB', 'State Postal Abbreviation'),
+    ('SUMLEVEL', 'Summary Level'),
+    ('COMPONENT', 'Geographic Component'),
+    ('LOGRECNO', 'Logical Record Number'),
+    ('STATE', 'State (FIPS Code)'),
+    ('COUNTY', 'County of current residence'),
+    ('TRACT', 'Census Tract'),
+    ('BLKGRP', 'Block Group'),
+    ('GEOID', 'Geographic Identifier'),
+    ('NAME', 'Area Name'),
+    ('BLANK', 'Reserved Future Use'),
+    ('BLANK', 'Reserved Future Use')
+]
+
+# seconds between the memory samples taken while a phase runs
+MEMORY_INTERVAL = 0.1
+
+
+def make_acs_fixtures(data_dir, options):
+    """Write a synthetic lookup file, geography file template and state
+    archives of geography and sequence files to data_dir, these mimic
+    the structure of the files that download_acs_data fetches"""
+
+    rand = random.Random(options.seed)
+    yr, span = options.year, options.span
+    state_names, _ = utils.get_states_mapping(ACS_MOD)
+    state_fips, _ = utils.get_states_mapping(TIGER_MOD)
+
+    if not exists(data_dir):
+        os.makedirs(data_dir)
+
+    # the lookup file defines which cells of each sequence belong to
+    # each table, sequences start with six metadata fields
+    lookup_name = 'ACS_{span}yr_Seq_Table_Number_Lookup.txt'.format(
+        span=span)
+    seq_cells = OrderedDict()
+    with open(join(data_dir, lookup_name), 'wb') as lookup:
+        writer = csv.writer(lookup)
+        writer.writerow([
+            'File ID', 'Table ID', 'Sequence Number', 'Line Number',
+            'Start Position', 'Total Cells in Table',
+            'Total Cells in Sequence', 'Table Title', 'Subject Area'])
+
+        tbl_num = 1
+        for seq_num in xrange(1, options.sequences + 1):
+            seq = '{:04d}'.format(seq_num)
+            position = 7
+            for _ in xrange(options.tables):
+                table_id = 'B{:05d}'.format(tbl_num)
+                cells = rand.randint(1, options.cells)
+                writer.writerow([
+                    'ACSSF', table_id, seq, '', position,
+                    '{} CELLS'.format(cells), '',
+                    'Synthetic Table {}'.format(table_id), 'Benchmark'])
+                writer.writerow([
+                    'ACSSF', table_id, seq, '', '', '', '',
+                    'Universe:  Synthetic records', ''])
+                for line in xrange(1, cells + 1):
+                    writer.writerow([
+                        'ACSSF', table_id, seq, line, '', '', '',
+                        'Cell {}:'.format(line), ''])
+
+                position += cells
+                tbl_num += 1
+
+            seq_cells[seq] = position - 7
+
+    # the template is only used for geoheader column names, xlwt is an
+    # optional dependency that is needed to write it
+    import xlwt
+    workbook = xlwt.Workbook()
+    sheet = workbook.add_sheet('{}_SFGeoFileTemplate'.format(yr))
+    for cx, (name, description) in enumerate(GEO_TEMPLATE):
+        sheet.write(0, cx, name)
+        sheet.write(1, cx, description)
+
+    template = StringIO()
+    workbook.save(template)
+    template_zip = '{yr}_{span}yr_Summary_FileTemplates.zip'.format(
+        yr=yr, span=span)
+    with ZipFile(join(data_dir, template_zip), 'w', ZIP_DEFLATED) as z:
+        z.writestr('{}_SFGeoFileTemplate.xls'.format(yr), template.getvalue())
+
+    # each geography grouping holds its own logical records and every
+    # archive contains the geography file for the whole state
+    for st in options.states:
+        geo_rows = list()
+        for gx, geog in enumerate(acs.ACS_GEOGRAPHY):
+            sumlevel = '140' if gx == 0 else '050'
+            for rx in xrange(options.rows):
+                logrec = '{:07d}'.format(gx * options.rows + rx + 1)
+                geoid = '{0}00US{1:02d}{2}'.format(
+                    sumlevel, int(state_fips[st]), logrec)
+                geo_rows.append([
+                    'ACSSF', st, sumlevel, '00', logrec, state_fips[st],
+                    '', '', '', geoid, 'Synthetic Area {}'.format(logrec),
+                    '', ''])
+
+        geo_csv = StringIO()
+        csv.writer(geo_csv).writerows(geo_rows)
+
+        for gx, geog in enumerate(acs.ACS_GEOGRAPHY):
+            geog_dir = join(data_dir, geog.lower())
+            if not exists(geog_dir):
+                os.makedirs(geog_dir)
+
+            archive = '{state}_{geography}.zip'.format(
+                state=state_names[st], geography=geog)
+            with ZipFile(join(geog_dir, archive), 'w', ZIP_DEFLATED) as z:
+                z.writestr('g{yr}{span}{state}.csv'.format(
+                    yr=yr, span=span, state=st.lower()), geo_csv.getvalue())
+
+                for seq, cells in seq_cells.items():
+                    for file_char in ('e', 'm'):
+                        seq_csv = StringIO()
+                        writer = csv.writer(seq_csv)
+                        for rx in xrange(options.rows):
+                            logrec = '{:07d}'.format(
+                                gx * options.rows + rx + 1)
+                            row = [
+                                'ACSSF', '{0}{1}{2}'.format(
+                                    yr, file_char, span),
+                                st.lower(), '000', seq, logrec]
+                            row.extend([
+                                make_acs_value(rand) for _ in xrange(cells)])
+                            writer.writerow(row)
+
+                        seq_name = '{type}{yr}{span}{state}' \
+                                   '{seq}000.txt'.format(
+                            type=file_char, yr=yr, span=span,
+                            state=st.lower(), seq=seq)
+                        z.writestr(seq_name, seq_csv.getvalue())
+
+
+def make_acs_value(rand):
+    """Return a cell value with roughly the mix of integers, decimals,
+    blanks and '.' placeholders found in the ACS sequence files"""
+
+    draw = rand.random()
+    if draw < 0.05:
+        return ''
+    elif draw < 0.1:
+        return '.'
+    elif draw < 0.3:
+        return '{:.1f}'.format(rand.random() * 100)
+    else:
+        return str(rand.randint(0, 50000))
+
+
+def make_tiger_fixtures(data_dir, options):
+    """Write synthetic shapefiles for each of the requested TIGER products
+    and states to the paths that download_tiger_data expects"""
+
+    rand = random.Random(options.seed)
+    state_fips, _ = utils.get_states_mapping(TIGER_MOD)
+
+    for prod in options.products:
+        product = tiger.TIGER_PRODUCT[prod]
+        prod_class = ''.join([c for c in product if c.isalpha()])
+        prod_dir = join(data_dir, prod_class)
+        if not exists(prod_dir):
+            os.makedirs(prod_dir)
+
+        # blocks use 'GEOID10' as their primary key
+        geoid_field = 'GEOID10' if prod == 'b' else 'GEOID'
+        schema = {
+            'geometry': 'Polygon',
+            'properties': OrderedDict([
+                ('STATEFP', 'str:2'),
+                (geoid_field, 'str:15'),
+                ('NAMELSAD', 'str:100'),
+                ('ALAND', 'int:14'),
+                ('AWATER', 'int:14'),
+                ('INTPTLAT', 'str:11'),
+                ('INTPTLON', 'str:12')
+            ])
+        }
+
+        for st in options.states:
+            fips = '{:02d}'.format(int(state_fips[st]))
+            shp_name = 'tl_{yr}_{fips}_{name}.shp'.format(
+                yr=options.year, fips=state_fips[st], name=product.lower())
+            shp_path = join(prod_dir, shp_name)
+
+            with fiona.open(shp_path, 'w', 'ESRI Shapefile', schema,
+                            crs=from_epsg(4269)) as shp:
+                for fx in xrange(options.features):
+                    polygon = make_polygon(rand, fx, options.vertices)
+                    shp.write({
+                        'geometry': mapping(polygon),
+                        'properties': {
+                            'STATEFP': fips,
+                            geoid_field: '{0}{1:09d}'.format(fips, fx),
+                            'NAMELSAD': 'Synthetic {}'.format(fx),
+                            'ALAND': rand.randint(0, 10 ** 8),
+                            'AWATER': rand.randint(0, 10 ** 6),
+                            'INTPTLAT': '+45.0000000',
+                            'INTPTLON': '-122.0000000'
+                        }
+                    })
+
+
+def make_polygon(rand, index, vertices):
+    """Return a star shaped polygon with the supplied number of vertices
+    placed on a grid of 0.01 degree cells according to index"""
+
+    cx = -124 + (index % 500) * 0.01
+    cy = 42 + (index / 500) * 0.01
+    points = list()
+    for vx in xrange(vertices):
+        angle = 2 * pi * vx / vertices
+        radius = 0.003 + rand.random() * 0.002
+        points.append((cx + radius * cos(angle), cy + radius * sin(angle)))
+
+    return Polygon(points)
+
+
+def run_acs(options, results):
+    """Load the synthetic ACS fixtures with the phases used by
+    postgres_acs.main and record the metrics of each phase"""
+
+    args = ['-y', str(options.year), '-s'] + options.states + [
+        '-l', str(options.span), '-ld', options.loader,
+        '-cs', str(options.chunk_size), '-w', str(options.workers),
+        '-od', options.output_dir, '-p', options.password or '', '-nm']
+    if options.defer_constraints:
+        args.append('-dc')
+    args.extend(['-lo', options.layout, '-ct', options.cell_type])
+
+    gv = acs.process_options(args)
+    gv.data_dir = join(options.data_dir, ACS_MOD)
+    gv.engine = create_engine(get_pg_url(options))
+    gv.lookup_file = 'ACS_{span}yr_Seq_Table_Number_' \
+                     'Lookup.txt'.format(span=gv.span)
+    gv.metadata = MetaData(
+        bind=gv.engine,
+        schema=ACS_SCHEMA.format(yr=gv.acs_year, span=gv.span))
+    acs.gv = gv
+    parquet.configure(gv.output_dir)
+
+    acs.drop_create_acs_schema(True)
+    gv.completed = utils.get_completed(gv.engine, gv.metadata.schema)
+    run_phase('geoheader', acs.create_geoheader, results)
+    run_phase('acs_tables', acs.create_acs_tables, results)
+
+    if gv.defer_constraints and gv.loader != 'parquet':
+        run_phase('constraints', acs.add_deferred_constraints, results)
+
+
+def run_tiger(options, results):
+    """Load the synthetic TIGER fixtures with the phases used by
+    postgis_tiger.main and record the metrics of each phase"""
+
+    args = ['-y', str(options.year), '-s'] + options.states + [
+        '-dp'] + options.products + [
+        '-ld', options.loader, '-cs', str(options.chunk_size),
+        '-w', str(options.workers), '-od', options.output_dir,
+        '-p', options.password or '', '-nm', '-nfk']
+
+    gv = tiger.process_options(args)
+    gv.data_dir = join(options.data_dir, TIGER_MOD)
+    gv.engine = create_engine(get_pg_url(options))
+    gv.metadata = MetaData(
+        bind=gv.engine,
+        schema='tiger{yr}'.format(yr=gv.tiger_year))
+    tiger.gv = gv
+    parquet.configure(gv.output_dir)
+
+    tiger.create_tiger_schema(True)
+    tiger.download_tiger_data(shp_path_only=True)
+    run_phase('tiger', tiger.load_tiger_data, results)
+
+
+def run_phase(name, function, results):
+    """Time the supplied function, which must return the number of rows
+    that it loaded, and add its metrics to results"""
+
+    sampler = MemorySampler()
+    sampler.start()
+    start_time = time.time()
+    try:
+        row_count = function() or 0
+    finally:
+        seconds = time.time() - start_time
+        sampler.stop()
+
+    # the process wide peak is only used where /proc can't be sampled
+    results[name] = OrderedDict([
+        ('seconds', round(seconds, 3)),
+        ('rows', row_count),
+        ('rows_per_sec', round(row_count / seconds, 1) if seconds else 0),
+        ('peak_mb', round(sampler.peak_mb or get_peak_memory(), 1))
+    ])
+
+
+class MemorySampler(threading.Thread):
+    """Samples the resident memory of this process and of its child
+    processes (the worker pools of the load scripts) while a phase runs,
+    peak_mb is the largest value seen for any one of them, memory that
+    is allocated and freed between samples may be missed"""
+
+    def __init__(self, interval=MEMORY_INTERVAL):
+        super(MemorySampler, self).__init__()
+        self.daemon = True
+        self.interval = interval
+        self.peak_mb = 0
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.is_set():
+            self.sample()
+            self._stopped.wait(self.interval)
+
+    def sample(self):
+        self.peak_mb = max([self.peak_mb] + get_resident_memory())
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+        self.sample()
+
+
+def get_resident_memory():
+    """Returns the resident memory in megabytes of this process and each
+    of its child processes, an empty list is returned on systems without
+    /proc"""
+
+    pid = os.getpid()
+    page_mb = resource.getpagesize() / 1024. ** 2
+    sizes = list()
+    for stat_path in glob('/proc/[0-9]*/stat'):
+        try:
+            with open(stat_path) as stat_file:
+                stat = stat_file.read()
+        except IOError:
+            # the process exited after the directory was listed
+            continue
+
+        # the command name is wrapped in parentheses and may contain
+        # spaces, the parent pid and resident pages are counted from the
+        # fields that follow it
+        head, _, tail = stat.rpartition(')')
+        fields = tail.split()
+        if int(head.split(None, 1)[0]) == pid or int(fields[1]) == pid:
+            sizes.append(int(fields[21]) * page_mb)
+
+    return sizes
+
+
+def get_peak_memory():
+    """Returns the peak resident memory in megabytes of this process or
+    its largest child process over the lifetime of this process, linux
+    reports ru_maxrss in kilobytes"""
+
+    peak = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+    return peak / 1024.
+
+
+def get_pg_url(options):
+    """"""
+
+    return PG_URL.format(user=options.user, pw=options.password or '',
+                         host=options.host, db=options.dbname)
+
+
+def get_fixture_key(options):
+    """Fixtures are keyed on the settings that determine their content
+    so they can be reused by runs with the same scale"""
+
+    settings = [
+        ('year', options.year),
+        ('span', options.span),
+        ('states', ','.join(options.states)),
+        ('sequences', options.sequences),
+        ('tables', options.tables),
+        ('cells', options.cells),
+        ('rows', options.rows),
+        ('products', ','.join(options.products)),
+        ('features', options.features),
+        ('vertices', options.vertices),
+        ('seed', options.seed)
+    ]
+
+    return ';'.join(['{0}={1}'.format(k, v) for k, v in settings])
+
+
+def get_scenario(options):
+    """Baselines are keyed on the settings that affect performance so
+    that runs are only compared with runs at the same scale and with
+    the same loader settings"""
+
+    settings = [
+        ('phases', ','.join(options.phases)),
+        ('loader', options.loader),
+        ('chunk_size', options.chunk_size),
+        ('workers', options.workers),
+        ('defer_constraints', options.defer_constraints)
+    ]
+
+    if options.layout != 'table':
+        settings.append(('layout', options.layout))
+    if options.cell_type != 'numeric':
+        settings.append(('cell_type', options.cell_type))
+
+    return ';'.join([get_fixture_key(options)] + [
+        '{0}={1}'.format(k, v) for k, v in settings])
+
+
+def compare_to_baseline(results, baseline, tolerance):
+    """Returns a list of messages describing each phase whose throughput
+    or peak memory regressed by more than tolerance against baseline,
+    phases that don't load rows (constraints) are compared on their wall
+    time instead of their throughput"""
+
+    regressions = list()
+    for phase, metrics in results.items():
+        base = baseline.get(phase)
+        if not base:
+            continue
+
+        if not metrics['rows'] or not base['rows']:
+            if metrics['seconds'] > base['seconds'] * (1 + tolerance):
+                regressions.append(
+                    '{0}: {1:,.1f} seconds vs baseline {2:,.1f}'.format(
+                        phase, metrics['seconds'], base['seconds']))
+        elif metrics['rows_per_sec'] < base['rows_per_sec'] * (1 - tolerance):
+            regressions.append(
+                '{0}: {1:,.0f} rows/sec vs baseline {2:,.0f}'.format(
+                    phase, metrics['rows_per_sec'], base['rows_per_sec']))
+
+        if metrics['peak_mb'] > base['peak_mb'] * (1 + tolerance):
+            regressions.append(
+                '{0}: {1:,.1f} MB peak memory vs baseline {2:,.1f}'.format(
+                    phase, metrics['peak_mb'], base['peak_mb']))
+
+    return regressions
+
+
+def print_report(results):
+    """"""
+
+    template = '{0:<14}{1:>12}{2:>14}{3:>14}{4:>12}'
+    print '\n' + template.format(
+        'phase', 'seconds', 'rows', 'rows/sec', 'peak MB')
+    for phase, m in results.items():
+        print template.format(
+            phase, '{:,.1f}'.format(m['seconds']), '{:,}'.format(m['rows']),
+            '{:,.0f}'.format(m['rows_per_sec']),
+            '{:,.1f}'.format(m['peak_mb']))
+
+
+def process_options(arglist=None):
+    """"""
+
+    parser = ArgumentParser(
+        description='load synthetic census data into a throwaway database '
+                    'and report the throughput of each phase')
+    parser.add_argument(
+        '-ph', '--phases',
+        nargs='+',
+        default=['acs', 'tiger'],
+        choices=['acs', 'tiger'],
+        help='data products to benchmark'
+    )
+    parser.add_argument(
+        '-s', '--states',
+        nargs='+',
+        default=['OR', 'WA'],
+        help='states for which synthetic data is generated'
+    )
+    parser.add_argument(
+        '-y', '--year',
+        default=BENCHMARK_YEAR,
+        type=int,
+        help='year used to name the synthetic files and schemas, the '
+             'default is chosen so that real data isn\'t overwritten'
+    )
+    parser.add_argument(
+        '-l', '--span',
+        default=5,
+        type=int,
+        choices=utils.ACS_SPANS,
+        help='span of the synthetic ACS data'
+    )
+    parser.add_argument(
+        '-sq', '--sequences',
+        default=5,
+        type=int,
+        help='number of sequences in the synthetic ACS data'
+    )
+    parser.add_argument(
+        '-tb', '--tables',
+        default=10,
+        type=int,
+        help='number of tables in each synthetic sequence'
+    )
+    parser.add_argument(
+        '-c', '--cells',
+        default=20,
+        type=int,
+        help='maximum number of cells in each synthetic table'
+    )
+    parser.add_argument(
+        '-r', '--rows',
+        default=2000,
+        type=int,
+        help='number of logical records per state and geography grouping'
+    )
+    parser.add_argument(
+        '-dp', '--data_product',
+        nargs='+',
+        default=['bg', 't'],
+        choices=sorted(tiger.TIGER_PRODUCT.keys()),
+        dest='products',
+        help='synthetic TIGER products to generate'
+    )
+    parser.add_argument(
+        '-f', '--features',
+        default=2000,
+        type=int,
+        help='number of features per state in each TIGER product'
+    )
+    parser.add_argument(
+        '-v', '--vertices',
+        default=50,
+        type=int,
+        help='number of vertices in each synthetic polygon'
+    )
+    parser.add_argument(
+        '-dc', '--defer_constraints',
+        action='store_true',
+        help='benchmark the ACS load with deferred constraints'
+    )
+    parser.add_argument(
+        '-lo', '--layout',
+        default='table',
+        choices=acs.LAYOUTS,
+        help='storage layout of the ACS tables, see postgres_acs --help'
+    )
+    parser.add_argument(
+        '-ct', '--cell_type',
+        default='numeric',
+        choices=acs.CELL_TYPES,
+        help='type of the ACS cell columns, see postgres_acs --help'
+    )
+    parser.add_argument(
+        '--seed',
+        default=0,
+        type=int,
+        help='seed for the synthetic data generator'
+    )
+    parser.add_argument(
+        '-rg', '--regenerate',
+        action='store_true',
+        help='generate new fixtures even if they already exist'
+    )
+    parser.add_argument(
+        '-b', '--baseline',
+        default=join(BENCHMARK_DIR, 'baselines.json'),
+        help='json file in which baselines are stored'
+    )
+    parser.add_argument(
+        '-sb', '--save_baseline',
+        action='store_true',
+        help='store the results of this run as the baseline for its '
+             'scenario rather than comparing against it'
+    )
+    parser.add_argument(
+        '-tl', '--tolerance',
+        default=0.1,
+        type=float,
+        help='fraction by which a phase can be slower or use more memory '
+             'than its baseline before it is flagged as a regression'
+    )
+    parser = utils.add_loader_options(parser)
+    parser = utils.add_postgres_options(parser)
+
+    # the benchmark should never be pointed at a production database
+    parser.set_defaults(dbname='census_benchmark', data_dir=BENCHMARK_DIR)
+    options = parser.parse_args(arglist)
+    return options
+
+
+def main():
+    """>> benchmark -s OR WA -r 5000 -f 5000 --save_baseline"""
+
+    options = process_options(sys.argv[1:])
+    scenario = get_scenario(options)
+    fixture_hash = hashlib.md5(get_fixture_key(options)).hexdigest()
+    fixture_dir = join(options.data_dir, 'fixtures', fixture_hash)
+    options.data_dir = fixture_dir
+
+    if options.regenerate or not exists(fixture_dir):
+        print 'generating synthetic fixtures in: {}'.format(fixture_dir)
+        make_acs_fixtures(join(fixture_dir, ACS_MOD), options)
+        make_tiger_fixtures(join(fixture_dir, TIGER_MOD), options)
+
+    results = OrderedDict()
+    if 'acs' in options.phases:
+        run_acs(options, results)
+    if 'tiger' in options.phases:
+        run_tiger(options, results)
+
+    print_report(results)
+
+    baselines = dict()
+    if exists(options.baseline):
+        with open(options.baseline) as baseline_file:
+            baselines = json.load(baseline_file)
+
+    if options.save_baseline:
+        baselines[scenario] = results
+        if not exists(dirname(options.baseline)):
+            os.makedirs(dirname(options.baseline))
+
+        with open(options.baseline, 'w') as baseline_file:
+            json.dump(baselines, baseline_file, indent=2)
+        print '\nbaseline saved to: {}'.format(options.baseline)
+    elif scenario in baselines:
+        regressions = compare_to_baseline(
+            results, baselines[scenario], options.tolerance)
+        if regressions:
+            print '\nregressions against baseline:'
+            for r in regressions:
+                print r
+            sys.exit(1)
+        else:
+            print '\nno regressions against baseline'
+    else:
+        print '\nno baseline stored for this scenario, use ' \
+              '"--save_baseline" to create one'
+
+
+if __name__ == '__main__':
+    main()
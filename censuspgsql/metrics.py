@@ -0,0 +1,167 @@
+# Instrumentation that records the wall time, rows and bytes of each
+# phase of a load, events are written as json lines so that they can be
+# scraped by monitoring tools
+
+import cProfile
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from os.path import exists, join
+
+_config = {
+    'path': None,
+    'profile_dir': None
+}
+_local = threading.local()
+
+# only the running totals of each phase are kept in memory, the events
+# themselves are written to the metrics file if there is one, the lock
+# guards the totals against the download and comment threads
+_totals = OrderedDict()
+_totals_lock = threading.Lock()
+
+
+class PhaseTracker(object):
+    """Counters that the body of a phase can increment, they're included
+    in the event that is recorded when the phase ends, at which point
+    seconds is set to the elapsed time"""
+
+    def __init__(self):
+        self.rows = 0
+        self.bytes = 0
+        self.seconds = 0
+
+
+def configure(path=None, profile_dir=None):
+    """Set the file that events are appended to and the directory that
+    cProfile output is written to, either may be None to disable that
+    output"""
+
+    _config['path'] = path
+    _config['profile_dir'] = profile_dir
+    _totals.clear()
+
+    if profile_dir and not exists(profile_dir):
+        os.makedirs(profile_dir)
+
+
+def record(phase_name, seconds, rows=0, bytes_=0, **labels):
+    """Record a single event, labels identify the object that the phase
+    operated on (table, shapefile, etc.), returns the event"""
+
+    event = OrderedDict([
+        ('time', round(time.time(), 3)),
+        ('pid', os.getpid()),
+        ('phase', phase_name)
+    ])
+    event.update(sorted(labels.items()))
+    event.update([
+        ('seconds', round(seconds, 4)),
+        ('rows', rows),
+        ('bytes', bytes_),
+        ('rows_per_sec', round(rows / seconds, 1) if seconds else 0)
+    ])
+
+    # the file is opened for each event so that forked worker processes
+    # can append to it without sharing a file handle, writes of a single
+    # line in append mode don't interleave
+    if _config['path']:
+        with open(_config['path'], 'a') as metrics_file:
+            metrics_file.write(json.dumps(event) + '\n')
+
+    add_totals({phase_name: {
+        'events': 1, 'seconds': seconds, 'rows': rows, 'bytes': bytes_}})
+
+    return event
+
+
+@contextmanager
+def phase(phase_name, **labels):
+    """Context manager that times the enclosed block and records it as an
+    event, it yields a PhaseTracker whose rows and bytes attributes can
+    be set by the block, if profiling is enabled the outermost phase in
+    each thread is run under cProfile"""
+
+    depth = getattr(_local, 'depth', 0)
+    profiler = None
+    if _config['profile_dir'] and depth == 0:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    tracker = PhaseTracker()
+    _local.depth = depth + 1
+    start_time = time.time()
+    try:
+        yield tracker
+    finally:
+        tracker.seconds = time.time() - start_time
+        _local.depth = depth
+
+        if profiler:
+            profiler.disable()
+            label_str = '_'.join([str(v) for _, v in sorted(labels.items())])
+            prof_name = re.sub(r'[^\w.-]', '_', '{0}{1}-{2}.prof'.format(
+                phase_name, '_' + label_str if label_str else '',
+                os.getpid()))
+            profiler.dump_stats(join(_config['profile_dir'], prof_name))
+
+        record(phase_name, tracker.seconds, tracker.rows, tracker.bytes,
+               **labels)
+
+
+def add_totals(totals):
+    """Add the supplied per phase totals, which are keyed on phase name,
+    to those of this process"""
+
+    with _totals_lock:
+        for name, phase_total in totals.items():
+            total = _totals.setdefault(
+                name, {'events': 0, 'seconds': 0, 'rows': 0, 'bytes': 0})
+            for key, value in phase_total.items():
+                total[key] += value
+
+
+def run_job(job):
+    """Runs a (function, argument) job in a worker process and returns a
+    (result, totals) tuple, the totals are those of the phases that the
+    job recorded and are passed to add_totals by the parent process so
+    that its summary covers the work of its workers"""
+
+    function, argument = job
+
+    # a forked worker starts with a copy of the parent's totals
+    with _totals_lock:
+        _totals.clear()
+
+    result = function(argument)
+    with _totals_lock:
+        totals = OrderedDict(_totals)
+        _totals.clear()
+
+    return result, totals
+
+
+def print_summary():
+    """Print the totals of each phase, the seconds of phases that ran in
+    several processes or threads at once are summed and may exceed the
+    wall time of the load"""
+
+    with _totals_lock:
+        totals = OrderedDict(_totals)
+
+    template = '{0:<14}{1:>8}{2:>12}{3:>16}{4:>16}{5:>12}'
+    print '\n' + template.format(
+        'phase', 'events', 'seconds', 'rows', 'bytes', 'rows/sec')
+    for name, t in totals.items():
+        rate = t['rows'] / t['seconds'] if t['seconds'] else 0
+        print template.format(
+            name, t['events'], '{:,.1f}'.format(t['seconds']),
+            '{:,}'.format(t['rows']), '{:,}'.format(t['bytes']),
+            '{:,.0f}'.format(rate))
+
+    if _config['path']:
+        print '\nmetrics written to: {}'.format(_config['path'])
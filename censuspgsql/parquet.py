@@ -0,0 +1,208 @@
+# Writes the rows produced by the load scripts to parquet files rather
+# than to postgres, each table is a directory of files partitioned by
+# state, pyarrow is an optional dependency that's only imported when
+# this output is used
+
+import os
+import shutil
+import time
+from collections import defaultdict
+from glob import glob
+from itertools import islice
+from os.path import exists, join
+
+from geoalchemy2 import Geometry
+from sqlalchemy import BigInteger, Float, Integer, Numeric, REAL
+from sqlalchemy.dialects.postgresql import ARRAY
+
+import censuspgsql.metrics as metrics
+
+# the first of these columns found in a table is used to partition its
+# files, the column is encoded in the directory names (stusab=OR, etc.)
+# rather than in the files as most readers expect
+PARTITION_COLUMNS = ('stusab', 'statefp', 'statefp10')
+PART_FILE = 'part-0.parquet'
+
+_config = {
+    'output_dir': 'parquet'
+}
+
+# writers stay open so that each batch of rows becomes a row group of
+# the same file, they're keyed on file path, see close_writers
+_writers = dict()
+
+
+def configure(output_dir):
+    """"""
+
+    _config['output_dir'] = output_dir
+
+
+def clear_partitions(schema, tables, values):
+    """Remove the partitions of the supplied tables whose partition column
+    has one of the supplied values, this is done before states are loaded
+    so that files of a previous run are replaced, the partitions of other
+    tables in the schema are left in place"""
+
+    for table in tables:
+        for value in values:
+            for part_dir in glob(join(_config['output_dir'], schema, table,
+                                      '*={}'.format(value))):
+                shutil.rmtree(part_dir)
+
+
+def write_rows(table, rows, batch_size):
+    """Write rows, which must be ordered like the table's columns, to the
+    parquet files of the supplied table, each batch of rows is written as
+    a row group of the file for its partition, returns the number of
+    rows written"""
+
+    import pyarrow as pa
+
+    names = [c.name for c in table.columns]
+    part_col = next((p for p in PARTITION_COLUMNS if p in names), None)
+    part_ix = names.index(part_col) if part_col else None
+    converters = [get_converter(c.type) for c in table.columns
+                  if c.name != part_col]
+
+    row_count = 0
+    start_time = time.time()
+    iterator = iter(rows)
+    while True:
+        batch = list(islice(iterator, batch_size))
+        if not batch:
+            break
+
+        part_rows = defaultdict(list)
+        for row in batch:
+            part_rows[row[part_ix] if part_col else None].append(row)
+
+        for value, value_rows in part_rows.items():
+            # the partition column is dropped, the remaining columns line
+            # up with the fields of the file's schema
+            writer, schema = get_writer(table, part_col, value)
+            columns = [v for cx, v in enumerate(zip(*value_rows))
+                       if cx != part_ix]
+            arrays = [pa.array(map(convert, values), type=type_)
+                      for convert, values, type_
+                      in zip(converters, columns, schema.types)]
+
+            writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+
+        row_count += len(batch)
+
+    metrics.record('write', time.time() - start_time, row_count,
+                   table=table.fullname)
+
+    return row_count
+
+
+def get_writer(table, part_col, value):
+    """Returns the (writer, arrow schema) of the file that holds the
+    supplied partition of table, the writer is opened if needed"""
+
+    import pyarrow.parquet as pq
+
+    table_dir = join(_config['output_dir'], table.schema, table.name)
+    if part_col:
+        table_dir = join(table_dir, '{0}={1}'.format(part_col, value))
+
+    file_path = join(table_dir, PART_FILE)
+    if file_path not in _writers:
+        if not exists(table_dir):
+            os.makedirs(table_dir)
+
+        schema = get_arrow_schema(table, part_col)
+        _writers[file_path] = pq.ParquetWriter(file_path, schema), schema
+
+    return _writers[file_path]
+
+
+def close_writers():
+    """Close the open writers, which writes the footers of their files,
+    this must be called once all of a table's rows have been written"""
+
+    for writer, _ in _writers.values():
+        writer.close()
+
+    _writers.clear()
+
+
+def get_arrow_schema(table, exclude=None):
+    """Returns an arrow schema that matches the columns of the supplied
+    table, the table and column comments are kept as metadata as are the
+    geometry type and srid of geometry columns"""
+
+    import pyarrow as pa
+
+    fields = list()
+    for c in table.columns:
+        if c.name == exclude:
+            continue
+
+        metadata = {'comment': c.doc} if c.doc else dict()
+        if isinstance(c.type, Geometry):
+            metadata.update({
+                'encoding': 'WKB',
+                'geometry_type': c.type.geometry_type,
+                'srid': str(c.type.srid)
+            })
+
+        fields.append(pa.field(
+            c.name, get_arrow_type(c.type),
+            metadata={k: encode(v) for k, v in metadata.items()}))
+
+    comment = table.info.get('comment')
+    return pa.schema(
+        fields, metadata={'comment': encode(comment)} if comment else None)
+
+
+def encode(value):
+    """Metadata values must be bytes, comments may be unicode or utf8
+    encoded strings"""
+
+    if isinstance(value, unicode):
+        return value.encode('utf8')
+    else:
+        return str(value)
+
+
+def get_arrow_type(col_type):
+    """Returns the arrow type that is equivalent to the supplied
+    sqlalchemy type, numerics are stored as doubles"""
+
+    import pyarrow as pa
+
+    # subclasses are checked ahead of the classes they derive from
+    if isinstance(col_type, ARRAY):
+        return pa.list_(get_arrow_type(col_type.item_type))
+    elif isinstance(col_type, BigInteger):
+        return pa.int64()
+    elif isinstance(col_type, Integer):
+        return pa.int32()
+    elif isinstance(col_type, REAL):
+        return pa.float32()
+    elif isinstance(col_type, (Float, Numeric)):
+        return pa.float64()
+    elif isinstance(col_type, Geometry):
+        return pa.binary()
+    else:
+        return pa.string()
+
+
+def get_converter(col_type):
+    """Returns a function that converts the values that the load scripts
+    produce for the supplied type, which are mostly strings, to python
+    values that arrow accepts, None is passed through"""
+
+    if isinstance(col_type, ARRAY):
+        item_converter = get_converter(col_type.item_type)
+        return lambda v: None if v is None else map(item_converter, v)
+    elif isinstance(col_type, Integer):
+        cast = int
+    elif isinstance(col_type, (Float, Numeric)):
+        cast = float
+    else:
+        return lambda v: v
+
+    return lambda v: None if v is None else cast(v)
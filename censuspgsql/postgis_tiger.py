@@ -1,20 +1,23 @@
 import os
 import sys
+import time
 from argparse import ArgumentParser
-from functools import partial
-from os.path import basename, exists, join, splitext
+from itertools import izip
+from os.path import basename, dirname, exists, join, splitext
 from zipfile import ZipFile
 
 import fiona
-import pyproj
+import numpy as np
 import sqlalchemy
 from geoalchemy2 import Geometry
-from geoalchemy2.elements import WKTElement
-from shapely import ops
-from shapely.geometry import shape, MultiPolygon
-from sqlalchemy import create_engine, MetaData, \
+from pyproj import Transformer
+from shapely import wkb
+from shapely.geometry import shape, MultiPolygon, Polygon
+from sqlalchemy import create_engine, select, text, MetaData, \
     Table, Column, ForeignKeyConstraint, Float, Integer, Text
 
+import censuspgsql.metrics as metrics
+import censuspgsql.parquet as parquet
 import censuspgsql.utilities as utils
 from censuspgsql.utilities import ACS_SCHEMA, ACS_SPANS, \
     GEOHEADER, GEOID, PG_URL, TIGER_GEOID, TIGER_MOD
@@ -34,6 +37,7 @@ def download_tiger_data(shp_path_only=False):
         yr=gv.tiger_year)
 
     gv.shp = dict()
+    downloads = list()
     for prod in gv.product:
         prod_name = TIGER_PRODUCT[prod].lower()
         prod_class = ''.join([c for c in TIGER_PRODUCT[prod] if c.isalpha()])
@@ -43,6 +47,10 @@ def download_tiger_data(shp_path_only=False):
             os.makedirs(prod_dir)
 
         for st in gv.states:
+            # when adding states those already in the table are skipped
+            if int(gv.state_fips[st]) in gv.loaded_fips.get(prod, set()):
+                continue
+
             prod_url = '{base_url}/{class_}/' \
                        'tl_{yr}_{fips}_{name}.zip'.format(
                             base_url=tiger_url, class_=prod_class,
@@ -54,12 +62,36 @@ def download_tiger_data(shp_path_only=False):
             shp_name = '{}.shp'.format(splitext(basename(prod_url))[0])
             shp_path = join(prod_dir, shp_name)
             gv.shp[shp_path] = prod
+            downloads.append((prod_url, prod_dir))
 
-            if not shp_path_only:
-                prod_path = utils.download_with_progress(prod_url, prod_dir)
+    if not shp_path_only:
+        download_paths = utils.download_files(downloads, gv.download_workers)
+        for prod_path in download_paths:
+            with metrics.phase('unzip', file=basename(prod_path)) as tracker:
                 with ZipFile(prod_path, 'r') as z:
-                    print '\nunzipping...'
-                    z.extractall(prod_dir)
+                    print '\nunzipping {}...'.format(basename(prod_path))
+                    z.extractall(dirname(prod_path))
+                    tracker.bytes = sum([i.file_size for i in z.infolist()])
+
+
+def get_loaded_fips():
+    """Returns a dictionary that maps each of the selected products to
+    the fips codes of the states whose features are already in its
+    table, products whose table doesn't exist are omitted"""
+
+    loaded_fips = dict()
+    for prod in gv.product:
+        table = utils.get_table(gv.metadata, TIGER_PRODUCT[prod].lower())
+        if table is None:
+            continue
+
+        # blocks have a column named 'statefp10' rather than 'statefp',
+        # codes are compared as integers since the table's are zero padded
+        fips_col = [c for c in table.columns if c.name.startswith('statefp')]
+        loaded_fips[prod] = {int(r[0]) for r in gv.engine.execute(
+            select([fips_col[0]]).distinct())}
+
+    return loaded_fips
 
 
 def create_tiger_schema(drop_existing=False):
@@ -82,66 +114,230 @@ def create_tiger_schema(drop_existing=False):
 def load_tiger_data():
     """"""
 
-    transformation = check_epsg_for_transformation()
+    gv.transformer = check_epsg_for_transformation()
 
-    # if the foreign key flag is set to true reflect geoheader tables
+    # if the foreign key flag is set to true find the geoheader tables
     # in matching acs schemas, tiger data is matched to acs that is one
-    # year less recent because it is released one year sooner
-    if gv.foreign_key:
+    # year less recent because it is released one year sooner, the
+    # geoheaders are only reflected if a table that refers to them is
+    # created, partitioned geoheaders are skipped since their tiger_geoid
+    # isn't unique, foreign keys don't apply to parquet files
+    gv.geoheader_schemas = list()
+    if gv.foreign_key and gv.loader != 'parquet':
         acs_year = gv.tiger_year - 1
-        for i in ACS_SPANS:
-            # FIXME should probably template this on global level
-            acs_schema = ACS_SCHEMA.format(yr=acs_year, span=i)
-            try:
-                gv.metadata.reflect(schema=acs_schema, only=[GEOHEADER])
-            except sqlalchemy.exc.InvalidRequestError:
-                pass
-
-    for shp_path, product in gv.shp.items():
-        with fiona.open(shp_path) as tiger_shape:
-            shp_metadata = tiger_shape.meta.copy()
-            table = create_tiger_table(shp_metadata, product)
+        acs_schemas = [ACS_SCHEMA.format(yr=acs_year, span=i)
+                       for i in ACS_SPANS]
+        gv.geoheader_schemas = [r[0] for r in gv.engine.execute(
+            text("SELECT n.nspname FROM pg_class c "
+                 "JOIN pg_namespace n ON n.oid = c.relnamespace "
+                 "WHERE c.relname = :table AND c.relkind = 'r' "
+                 "AND n.nspname IN :schemas ORDER BY n.nspname;"),
+            table=GEOHEADER, schemas=tuple(acs_schemas))]
+
+    # each product's table is created by this process before any data
+    # is loaded so that concurrent workers never race to create it
+    gv.tiger_tables = dict()
+    for shp_path, product in sorted(gv.shp.items()):
+        if product not in gv.tiger_tables:
+            with fiona.open(shp_path) as tiger_shape:
+                shp_metadata = tiger_shape.meta.copy()
+                gv.tiger_tables[product] = create_tiger_table(
+                    shp_metadata, product)
+
+    # connections can't be shared across a fork, so the parent's pool
+    # is emptied and each worker creates an engine of its own
+    shp_paths = sorted(gv.shp.keys())
+    if gv.workers > 1:
+        print '\nloading {0} shapefiles with {1} workers...'.format(
+            len(shp_paths), gv.workers)
+        gv.engine.dispose()
+
+    feat_total = 0
+    start_time = time.time()
+    for shp_path, feat_count in utils.map_jobs(
+            load_shapefile, shp_paths, gv.workers, init_worker):
+        feat_total += feat_count
+        if gv.workers > 1:
+            print 'loaded {0:,} features from "{1}"'.format(
+                feat_count, basename(shp_path))
+
+    if gv.workers > 1:
+        utils.print_throughput(
+            feat_total, time.time() - start_time, 'features')
+
+    if gv.optimize and gv.loader != 'parquet':
+        optimize_tiger_tables()
+
+    return feat_total
+
+
+def optimize_tiger_tables():
+    """Build the spatial index of each tiger table now that its data has
+    been loaded, optionally cluster the table on that index and refresh
+    its statistics, the time taken by each step is reported"""
+
+    print '\noptimizing tiger tables...'
+    for product, table in sorted(gv.tiger_tables.items()):
+        # the index name matches the one geoalchemy2 generates when the
+        # index is created along with the table
+        index = 'idx_{}_geom'.format(table.name)
+        utils.run_timed(
+            gv.engine, '{}: gist index'.format(table.fullname),
+            ['CREATE INDEX IF NOT EXISTS {0} ON {1} '
+             'USING GIST (geom);'.format(index, table.fullname)])
+
+        if gv.cluster:
+            utils.run_timed(
+                gv.engine, '{}: cluster'.format(table.fullname),
+                ['CLUSTER {0} USING {1};'.format(table.fullname, index)])
+
+        utils.run_timed(
+            gv.engine, '{}: analyze'.format(table.fullname),
+            ['ANALYZE {};'.format(table.fullname)])
+
+
+def init_worker():
+    """"""
 
+    gv.engine = create_engine(gv.engine.url)
+    gv.transformer = check_epsg_for_transformation()
+
+
+def load_shapefile(shp_path):
+    """"""
+
+    table = gv.tiger_tables[gv.shp[shp_path]]
+    with fiona.open(shp_path) as tiger_shape:
+        if gv.workers <= 1:
             print '\nloading shapefile "{0}" ' \
                   'into table: "{1}.{2}":'.format(
                        basename(shp_path), gv.metadata.schema, table.name)
             print 'features inserted:'
 
-            memory_tbl = list()
-            max_fid = max(tiger_shape.keys())
-            for fid, feat in tiger_shape.items():
-                fields = feat['properties']
-                row = {k.lower(): v for k, v in fields.items()}
+        # features are streamed to the database with COPY (or batched
+        # inserts) as they're read from the shapefile, so the time taken
+        # to parse and reproject them is included in this phase
+        shp_name = basename(shp_path)
+        with metrics.phase('load', shapefile=shp_name) as tracker:
+            feat_rows = read_tiger_features(
+                tiger_shape, table, gv.transformer)
+            tracker.rows = utils.load_rows(
+                gv.engine, table, feat_rows, gv.loader, gv.chunk_size)
+        feat_count = tracker.rows
+
+    # the parquet files are only valid once their writers are closed
+    if gv.loader == 'parquet':
+        parquet.close_writers()
+
+    if gv.workers <= 1:
+        utils.print_throughput(
+            feat_count, tracker.seconds, 'features')
+
+    return shp_path, feat_count
+
+
+def read_tiger_features(tiger_shape, table, transformer=None):
+    """Generator that yields the features of the supplied fiona collection
+    as rows ordered like the columns of table, geometries are encoded as
+    hex EWKB which postgis accepts without parsing any text, or as plain
+    WKB for the parquet loader which records the srid in the schema"""
+
+    # features are read in batches so that the coordinates of an entire
+    # batch can be reprojected with a single call to pyproj
+    field_names = [c.name for c in table.columns]
+    plain_wkb = gv.loader == 'parquet'
+    count = 0
+    for batch in utils.iter_chunks(tiger_shape, gv.chunk_size):
+        geoms = [to_multipolygon(shape(f['geometry'])) for f in batch]
+        if transformer:
+            geoms = transform_geometries(geoms, transformer)
+
+        for feat, shapely_geom in izip(batch, geoms):
+            fields = {k.lower(): v for k, v in feat['properties'].items()}
+            if plain_wkb:
+                fields['geom'] = wkb.dumps(shapely_geom)
+            else:
+                fields['geom'] = wkb.dumps(
+                    shapely_geom, hex=True, srid=gv.epsg)
+
+            # fiona returns text as unicode which is encoded here so that
+            # the rows can be written by the csv module
+            row = list()
+            for name in field_names:
+                value = fields.get(name)
+                if isinstance(value, unicode):
+                    value = value.encode('utf8')
+                row.append(value)
+
+            yield row
+
+            # logging to inform the user, this is skipped when features are
+            # loaded by multiple processes as the output would interleave
+            count += 1
+            if gv.workers > 1:
+                continue
+            elif count % 20000 == 0:
+                sys.stdout.write(str(count))
+            elif count % 1000 == 0:
+                sys.stdout.write('..')
+
+
+def to_multipolygon(geom):
+    """Casting to multipolygon here because a few features are multi's
+    and the geometry types within a table must match"""
+
+    if isinstance(geom, MultiPolygon):
+        return geom
+    else:
+        return MultiPolygon([geom])
+
+
+def transform_geometries(geoms, transformer):
+    """Reproject a list of multipolygons by gathering the coordinates of
+    all of their rings into numpy arrays, transforming them with a single
+    call to the supplied pyproj transformer and reassembling the
+    geometries from the results"""
 
-                # casting to multipolygon here because a few features
-                # are multi's and the geometry types must match
-                shapely_geom = MultiPolygon([shape(feat['geometry'])])
+    ring_arrays = list()
+    for geom in geoms:
+        for poly in geom.geoms:
+            ring_arrays.append(np.asarray(poly.exterior.coords))
+            ring_arrays.extend(
+                [np.asarray(r.coords) for r in poly.interiors])
 
-                if transformation:
-                    shapely_geom = ops.transform(transformation, shapely_geom)
+    if not ring_arrays:
+        return geoms
 
-                # geoalchemy2 requires that geometry be in EWKT format
-                # for inserts, that conversion is made below
-                ga2_geom = WKTElement(shapely_geom.wkt, gv.epsg)
-                row['geom'] = ga2_geom
-                memory_tbl.append(row)
+    coords = np.concatenate(ring_arrays)
+    xs, ys = transformer.transform(coords[:, 0], coords[:, 1])
+    transformed = np.column_stack((xs, ys))
 
-                count = fid + 1
-                if count % 1000 == 0 or fid == max_fid:
-                    gv.engine.execute(table.insert(), memory_tbl)
-                    memory_tbl = list()
+    # the rings are consumed from the transformed array in the same order
+    # that they were added to it
+    offset = 0
+    ring_ix = 0
+    projected = list()
+    for geom in geoms:
+        polygons = list()
+        for poly in geom.geoms:
+            rings = list()
+            for _ in xrange(len(poly.interiors) + 1):
+                ring_len = len(ring_arrays[ring_ix])
+                rings.append(transformed[offset: offset + ring_len])
+                offset += ring_len
+                ring_ix += 1
 
-                    # logging to inform the user
-                    if count % 20000 == 0:
-                        sys.stdout.write(str(count))
-                    elif fid == max_fid:
-                        print '\n'
-                    else:
-                        sys.stdout.write('..')
+            polygons.append(Polygon(rings[0], rings[1:]))
+
+        projected.append(MultiPolygon(polygons))
+
+    return projected
 
 
 def check_epsg_for_transformation():
-    """"""
+    """Returns a pyproj transformer from the TIGER data's native spatial
+    reference system to the one requested by the user, or None if no
+    reprojection is needed"""
 
     # if shapefile paths haven't be stored in the global namespace
     # variable use the download function to get them
@@ -154,13 +350,15 @@ def check_epsg_for_transformation():
     epsg_shp_meta = epsg_shp.meta.copy()
     tiger_epsg = int(epsg_shp_meta['crs']['init'].split(':')[1])
 
+    # the transformer is built once and reused for every batch of
+    # features, always_xy keeps coordinates in lon/lat order regardless
+    # of the axis order defined by the target system
     if gv.epsg and gv.epsg != tiger_epsg:
-        transformation = partial(
-            pyproj.transform,
-            pyproj.Proj(init='epsg:{}'.format(tiger_epsg)),
-            pyproj.Proj(init='epsg:{}'.format(gv.epsg), preserve_units=True)
-        )
-        return transformation
+        transformer = Transformer.from_crs(
+            'epsg:{}'.format(tiger_epsg),
+            'epsg:{}'.format(gv.epsg),
+            always_xy=True)
+        return transformer
     else:
         gv.epsg = tiger_epsg
         return None
@@ -172,7 +370,8 @@ def create_tiger_table(shp_metadata, product, drop_existing=False):
     # handle cases where the table already exists
     schema = gv.metadata.schema
     table_name = TIGER_PRODUCT[product].lower()
-    if not drop_existing:
+    to_database = gv.loader != 'parquet'
+    if to_database and not drop_existing:
         engine = gv.engine
         if engine.dialect.has_table(engine.connect(), table_name, schema):
             full_name = '{0}.{1}'.format(schema, table_name)
@@ -180,7 +379,7 @@ def create_tiger_table(shp_metadata, product, drop_existing=False):
                   'using existing table...'.format(full_name)
             print 'to recreate the table use the "drop_existing" flag'
 
-            return gv.metadata.tables[full_name]
+            return utils.get_table(gv.metadata, table_name)
 
     fiona2db = {
         'int': Integer,
@@ -197,11 +396,14 @@ def create_tiger_table(shp_metadata, product, drop_existing=False):
         geom_type = 'MULTI{}'.format(geom_type)
 
     columns = list()
+    # when optimizing the spatial index is built after the data is loaded
+    # rather than being updated with each insert
     geom_col = Column(
         name='geom',
         type_=Geometry(
             geometry_type=geom_type,
-            srid=gv.epsg))
+            srid=gv.epsg,
+            spatial_index=not gv.optimize))
     columns.append(geom_col)
 
     for f_name, f_type in shp_metadata['schema']['properties'].items():
@@ -221,19 +423,21 @@ def create_tiger_table(shp_metadata, product, drop_existing=False):
     # add a foreign key to the ACS data unless options indicate not to, blocks
     # (pk of 'geoid10') aren't in the ACS so can't have the constraint
     if gv.foreign_key and pk_col == TIGER_PK:
-        meta_tables = gv.metadata.tables
-        geoheaders = [meta_tables[t] for t in meta_tables if GEOHEADER in t]
+        geoheaders = [utils.get_table(gv.metadata, GEOHEADER, gh_schema)
+                      for gh_schema in gv.geoheader_schemas]
 
         for gh in geoheaders:
             foreign_col = gh.columns[TIGER_GEOID]
             fk = ForeignKeyConstraint([pk_col], [foreign_col])
             columns.append(fk)
 
+    # with the parquet loader the table only defines the files' schema
     table = Table(
         table_name,
         gv.metadata,
         *columns)
-    table.create()
+    if to_database:
+        table.create()
 
     return table
 
@@ -269,13 +473,34 @@ def process_options(arglist=None):
         help='by default a foreign key to the ACS data is created if that '
              'data exists, use this flag to disable that constraint'
     )
+    parser.add_argument(
+        '-cl', '--cluster',
+        action='store_true',
+        help='when used with the "optimize" flag the tables are physically '
+             'reordered to match their spatial index with CLUSTER'
+    )
+    parser = utils.add_loader_options(parser)
+    parser = utils.add_metrics_options(parser)
     parser = utils.add_postgres_options(parser)
 
-    parser.set_defaults(shp=None)
+    parser.set_defaults(shp=None, loaded_fips=dict())
     options = parser.parse_args(arglist)
     return options
 
 
+def write_parquet_tables():
+    """Write the tables of the requested products to parquet files, only
+    the partitions of those tables are replaced so the files of products
+    that aren't requested are kept"""
+
+    parquet.configure(gv.output_dir)
+    parquet.clear_partitions(
+        gv.metadata.schema,
+        [TIGER_PRODUCT[prod].lower() for prod in gv.product],
+        ['{:02d}'.format(int(gv.state_fips[st])) for st in gv.states])
+    load_tiger_data()
+
+
 def main():
     """>> python postgis_tiger.py -y 2015 -s OR WA"""
 
@@ -283,6 +508,7 @@ def main():
     global gv  
     args = sys.argv[1:]
     gv = process_options(args)
+    metrics.configure(gv.metrics, gv.profile)
 
     pg_url = PG_URL.format(user=gv.user, pw=gv.password,
                            host=gv.host, db=gv.dbname)
@@ -291,12 +517,34 @@ def main():
         bind=gv.engine,
         schema='tiger{yr}'.format(yr=gv.tiger_year))
 
+    if gv.loader == 'parquet' and gv.add_states:
+        raise ValueError(
+            'the "add_states" flag only applies to the database, the parquet '
+            'loader replaces the files of the supplied states and leaves '
+            'those of other states in place')
+
+    # when adding states the existing tables are kept and the states
+    # that they already contain aren't downloaded or loaded again
+    gv.loaded_fips = get_loaded_fips() if gv.add_states else dict()
     download_tiger_data()
-    create_tiger_schema(True)
+    if not gv.shp:
+        print 'all of the supplied states are already loaded'
+        return
+
+    # the parquet loader writes the same tables to files partitioned by
+    # state and skips the steps that only apply to the database
+    if gv.loader == 'parquet':
+        write_parquet_tables()
+        metrics.print_summary()
+        return
+
+    create_tiger_schema(not gv.add_states)
     load_tiger_data()
 
     if gv.model:
-        utils.generate_model(gv.metadata)
+        utils.generate_model(gv.metadata, workers=gv.workers)
+
+    metrics.print_summary()
 
 
 if __name__ == '__main__':
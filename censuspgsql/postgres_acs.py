@@ -1,20 +1,29 @@
+import cPickle
 import csv
 import os
 import re
 import sys
+import time
 from argparse import ArgumentParser
-from collections import OrderedDict
-from copy import deepcopy
-from os.path import dirname, exists, join
+from collections import defaultdict, OrderedDict
+from glob import glob
+from itertools import islice, izip_longest
+from multiprocessing.pool import ThreadPool
+from operator import attrgetter, itemgetter
+from os.path import basename, exists, getmtime, join
 from zipfile import ZipFile
 
+import sqlalchemy
 import xlrd
-from sqlalchemy import create_engine, Column,\
-    ForeignKeyConstraint, MetaData, Numeric, Table, Text
+from sqlalchemy import create_engine, text, BigInteger, Column,\
+    ForeignKeyConstraint, Integer, MetaData, Numeric, REAL, Table, Text
+from sqlalchemy.dialects.postgresql import ARRAY, DOUBLE_PRECISION
 
+import censuspgsql.metrics as metrics
+import censuspgsql.parquet as parquet
 import censuspgsql.utilities as utils
 from censuspgsql.utilities import ACS_MOD, ACS_SCHEMA, ACS_SPANS, \
-    GEOHEADER, GEOID, PG_URL, TIGER_GEOID
+    GEOHEADER, GEOID, LEDGER, PG_URL, TIGER_GEOID
 
 ACS_PRIMARY_KEY = OrderedDict([
     ('stusab', 'State Postal Abbreviation'),
@@ -27,33 +36,76 @@ ACS_GEOGRAPHY = [
     'All_Geographies_Not_Tracts_Block_Groups'
 ]
 
+# these summary levels are excluded from the tiger_geoid because their
+# values are not unique from each other, sumlevels 050 and 160 also
+# conflict with these, but remain unique if these are excluded, more
+# info on summary levels here:
+# http://www2.census.gov/programs-surveys/acs/summary_file/2014/
+# documentation/tech_docs/ACS_2014_SF_5YR_Appendices.xls
+TIGER_SUMLEV_EXCLUDE = frozenset([
+    '320', '610', '612',
+    '620', '622', '795',
+    '950', '960', '970'
+])
+TIGER_GEOID_REGEX = re.compile(r'\w*US(\w*)')
+
+# the estimate and margin of error variant of each table are read from
+# sequence files prefixed with these characters
+ACS_VARIANTS = (('e', ''), ('m', '_moe'))
+
+# with the 'sequence' layout each sequence is loaded into a single wide
+# table that holds the estimates and margins of error of all of the
+# tables within it, views with the names of the ACS tables are created
+# on top of these, postgres allows at most 1600 columns per table
+LAYOUTS = ('table', 'sequence')
+SEQUENCE_TABLE = 'seq{}'
+MAX_COLUMNS = 1600
+VIEW_BATCH = 100
+
+# with the 'compact' and 'array' cell types the type of each cell is
+# chosen from the values in the first SAMPLE_ROWS records of each of
+# the sequence files, integers are only given the 'integer' type when
+# their magnitude leaves INTEGER_HEADROOM times that much room within
+# its range for geographies that weren't sampled and decimals are only
+# given the 'real' type if they have at most REAL_DIGITS digits
+CELL_TYPES = ('numeric', 'compact', 'array')
+SAMPLE_ROWS = 1000
+INTEGER_HEADROOM = 16
+REAL_DIGITS = 6
+ARRAY_COLUMN = 'cells'
+
+# the parsed lookup file is cached as a catalog, the version must be
+# incremented whenever the structure of the catalog changes
+CATALOG_FILE = 'lookup_catalog_{yr}_{span}yr.pickle'
+CATALOG_VERSION = 1
+
+# when partitioning each table is split into a partition per state, a
+# state's rows are loaded into a staging table that is swapped in as its
+# partition once complete
+PARTITION_BY = 'LIST (stusab)'
+PARTITION_TABLE = '{table}_{state}'
+STAGE_TABLE = '{}_stage'
+
+# number of tables whose comments are sent in a single transaction
+COMMENT_BATCH = 100
+COMMENT_LEDGER = 'comments'
+CONSTRAINT_LEDGER = 'constraints'
+STATE_LEDGER = 'state:{}'
+
+# maximum number of tables analyzed in a single transaction
+ANALYZE_BATCH = 500
+
+# position of the primary key fields within the sequence files
+SEQ_STUSAB_IX = 2
+SEQ_LOGREC_IX = 5
+
 
 def download_acs_data():
     """"""
 
-    # get raw census data in text delimited form, the data has been
-    # grouped into what the Census Bureau calls 'sequences'
     acs_url = 'http://www2.census.gov/programs-surveys/' \
               'acs/summary_file/{yr}'.format(yr=gv.acs_year)
 
-    for geog in ACS_GEOGRAPHY:
-        geog_dir = join(gv.data_dir, geog.lower())
-
-        if not exists(geog_dir):
-            os.makedirs(geog_dir)
-
-        for st in gv.states:
-            st_name = gv.state_names[st]
-            geog_url = '{base_url}/data/{span}_year_by_state/' \
-                       '{state}_{geography}.zip'.format(
-                            base_url=acs_url, span=gv.span,
-                            state=st_name, geography=geog)
-
-            geog_path = utils.download_with_progress(geog_url, geog_dir)
-            with ZipFile(geog_path, 'r') as z:
-                print '\nunzipping...'
-                z.extractall(dirname(geog_path))
-
     # the raw csv doesn't have field names for metadata, the templates
     # downloaded below provide that (but only the geoheader metadata
     # will be used by this process)
@@ -61,16 +113,109 @@ def download_acs_data():
                  'Summary_FileTemplates.zip'.format(
                       base_url=acs_url, yr=gv.acs_year, span=gv.span)
 
-    schema_path = utils.download_with_progress(schema_url, gv.data_dir)
-    with ZipFile(schema_path, 'r') as z:
-        print '\nunzipping...'
-        z.extractall(dirname(schema_path))
-
     # download the lookup table that contains information as to how to
-    # extract the ACS tables from the sequences
+    # extract the ACS tables from the sequences, it's fetched ahead of
+    # the data since it determines which sequences the selected tables
+    # are found in
     lookup_url = '{base_url}/documentation/user_tools/' \
                  '{lookup}'.format(base_url=acs_url, lookup=gv.lookup_file)
-    utils.download_with_progress(lookup_url, gv.data_dir)
+    utils.download_files(
+        [(schema_url, gv.data_dir), (lookup_url, gv.data_dir)],
+        gv.download_workers)
+
+    sequences = None
+    if is_filtered():
+        sequences = sorted({e['sequence'] for e in get_selected_catalog()})
+
+    # get raw census data in text delimited form, the data has been
+    # grouped into what the Census Bureau calls 'sequences'
+    downloads = list()
+    for geog in ACS_GEOGRAPHY:
+        geog_dir = join(gv.data_dir, geog.lower())
+
+        if not exists(geog_dir):
+            os.makedirs(geog_dir)
+
+        for st in gv.states:
+            st_name = gv.state_names[st]
+            state_zip = '{state}_{geography}.zip'.format(
+                state=st_name, geography=geog)
+
+            # when tables are selected only the archives of the sequences
+            # that they're in are fetched, along with the geography file,
+            # unless the archive of every sequence is already on hand
+            if sequences is None or exists(join(geog_dir, state_zip)):
+                geog_url = '{base_url}/data/{span}_year_by_state/' \
+                           '{state_zip}'.format(
+                                base_url=acs_url, span=gv.span,
+                                state_zip=state_zip)
+                downloads.append((geog_url, geog_dir))
+                continue
+
+            seq_url = '{base_url}/data/{span}_year_seq_by_state/' \
+                      '{state}/{geography}'.format(
+                           base_url=acs_url, span=gv.span,
+                           state=st_name, geography=geog)
+            geo_csv = 'g{yr}{span}{state}.csv'.format(
+                yr=gv.acs_year, span=gv.span, state=st.lower())
+            downloads.append(('{0}/{1}'.format(seq_url, geo_csv), geog_dir))
+
+            for seq in sequences:
+                seq_zip = '{yr}{span}{state}{seq}000.zip'.format(
+                    yr=gv.acs_year, span=gv.span, state=st.lower(), seq=seq)
+                downloads.append(
+                    ('{0}/{1}'.format(seq_url, seq_zip), geog_dir))
+
+    # the archives aren't extracted, their members are streamed directly
+    # out of them when the tables are loaded
+    utils.download_files(downloads, gv.download_workers)
+
+
+def find_archive_member(directory, file_name):
+    """Locate the named file within the zip archives that have been
+    downloaded to the supplied directory, returns an (archive path, member
+    name) tuple, if the file exists uncompressed in the directory the
+    archive path is None, if the file can't be found None is returned"""
+
+    # the contents of each directory's archives are indexed the first
+    # time it's searched, members are keyed on their base name as some
+    # archives nest their files in folders
+    if directory not in gv.archive_index:
+        member_index = dict()
+        for zip_path in sorted(glob(join(directory, '*.zip'))):
+            with ZipFile(zip_path, 'r') as z:
+                for member in z.namelist():
+                    member_index[basename(member)] = (zip_path, member)
+
+        gv.archive_index[directory] = member_index
+
+    file_path = join(directory, file_name)
+    if exists(file_path):
+        return None, file_path
+    else:
+        return gv.archive_index[directory].get(file_name)
+
+
+def open_archive_member(directory, file_name):
+    """Returns a file object for the named file from the zip archives of
+    the supplied directory, see find_archive_member"""
+
+    location = find_archive_member(directory, file_name)
+    if location is None:
+        raise IOError('"{0}" could not be found in the archives within '
+                      '{1}'.format(file_name, directory))
+
+    archive_path, member = location
+    if archive_path is None:
+        return open(member)
+
+    # each call to ZipFile.open creates its own file handle, so the
+    # cached archive objects can be reused by sequential reads and by
+    # forked worker processes
+    if archive_path not in gv.archives:
+        gv.archives[archive_path] = ZipFile(archive_path, 'r')
+
+    return gv.archives[archive_path].open(member)
 
 
 def drop_create_acs_schema(drop_existing=False):
@@ -84,14 +229,18 @@ def drop_create_acs_schema(drop_existing=False):
 
         # drop in tables in chunks so max number of locks isn't exceeded,
         # geoheader needs to be dropped last since it has a foreign key to
-        # all other tables
+        # all other tables, partitions are dropped along with their parent
+        # so the chunks are made smaller when the tables are partitioned
         tbl_query = engine.execute(
-            "SELECT tablename FROM pg_tables "
-            "WHERE schemaname = '{0}' "
-            "AND tablename != '{1}';".format(schema, GEOHEADER))
-        tbl_list = [t[0] for t in tbl_query]
-
-        step = 500
+            "SELECT c.relname, c.relispartition FROM pg_class c "
+            "JOIN pg_namespace n ON n.oid = c.relnamespace "
+            "WHERE n.nspname = '{0}' AND c.relkind IN ('r', 'p') "
+            "AND c.relname != '{1}';".format(schema, GEOHEADER)).fetchall()
+        tbl_list = [t[0] for t in tbl_query if not t[1]]
+        part_count = len(tbl_query) - len(tbl_list)
+
+        step = max(500 * len(tbl_list) / (len(tbl_list) + part_count), 1) \
+            if tbl_list else 500
         drop_template = "DROP TABLE {} CASCADE;"
         for start_ix in xrange(0, len(tbl_list), step):
             end_ix = start_ix + step
@@ -105,15 +254,16 @@ def drop_create_acs_schema(drop_existing=False):
 
         engine.execute("DROP SCHEMA IF EXISTS {} CASCADE;".format(schema))
 
-    engine.execute("CREATE SCHEMA {};".format(schema))
+    engine.execute("CREATE SCHEMA IF NOT EXISTS {};".format(schema))
+    utils.create_ledger(engine, schema)
 
 
 def create_geoheader():
     """"""
 
     geo_xls = '{yr}_SFGeoFileTemplate.xls'.format(yr=gv.acs_year)
-    geo_schema = join(gv.data_dir, geo_xls)
-    book = xlrd.open_workbook(geo_schema)
+    with open_archive_member(gv.data_dir, geo_xls) as geo_schema:
+        book = xlrd.open_workbook(file_contents=geo_schema.read())
     sheet = book.sheet_by_index(0)
 
     columns = []
@@ -132,7 +282,8 @@ def create_geoheader():
             type_=Text,
             doc=sheet.cell_value(1, cx).encode('utf8')
         )
-        if cur_col.name.lower() in ACS_PRIMARY_KEY:
+        if cur_col.name.lower() in ACS_PRIMARY_KEY \
+                and not gv.defer_constraints:
             cur_col.primary_key = True
         else:
             cur_col.primary = False
@@ -141,14 +292,15 @@ def create_geoheader():
 
     # The 'geoid' field that exists within tiger shapefiles is a
     # truncated version of the full census geoid, this column will hold
-    # the truncated version
+    # the truncated version, if constraints are deferred its index is
+    # built by add_deferred_constraints
     tiger_geoid = Column(
         name=TIGER_GEOID,
         type_=Text,
         doc='Truncated version of geoid used to join with '
             'to tables derived from TIGER shapefiles',
-        unique=True,
-        index=True
+        unique=not (gv.defer_constraints or gv.partition),
+        index=not gv.defer_constraints
     )
     columns.append(tiger_geoid)
 
@@ -158,233 +310,1257 @@ def create_geoheader():
         tbl_name,
         gv.metadata,
         *columns,
-        info=tbl_comment)
+        info={'comment': tbl_comment},
+        **get_partition_kwargs())
 
+    # the parquet loader writes the comments along with the rows
     print '\ncreating geoheader...'
-    table.create()
-    add_database_comments(table)
+    if gv.loader != 'parquet':
+        table.create(checkfirst=gv.resume or gv.refresh or gv.add_states)
+        if gv.comments:
+            add_database_comments([table])
+
+    print 'loading geoheader rows...'
+    row_count = 0
+    start_time = time.time()
+    field_names = [c.name for c in columns]
+    for st in gv.states:
+        ledger_item = '{0}:{1}'.format(GEOHEADER, st)
+        if ledger_item in gv.completed:
+            continue
+
+        # rows from a state that didn't finish loading in a previous run
+        # are removed so it can be loaded from the beginning, when
+        # partitioning the state is loaded into a new staging table
+        target = table
+        if gv.partition:
+            target = create_stage_table(table, st)
+        elif gv.resume:
+            gv.engine.execute(
+                table.delete().where(table.c.stusab == st))
+
+        # each state is written with a single COPY (or large batches of
+        # inserts) rather than a statement per row, since the rows are
+        # streamed the time to read them is included in this phase
+        with metrics.phase('geoheader', state=st) as tracker:
+            geo_rows = read_geoheader(st, field_names)
+            tracker.rows = utils.load_rows(
+                gv.engine, target, geo_rows, gv.loader, gv.chunk_size)
+        row_count += tracker.rows
+
+        if gv.partition:
+            attach_stage_tables([table], st)
+        if gv.loader == 'parquet':
+            parquet.close_writers()
+        else:
+            utils.mark_completed(gv.engine, gv.metadata.schema, ledger_item)
+        sys.stdout.write('.')
+
+    utils.print_throughput(row_count, time.time() - start_time)
+
+    return row_count
+
+
+def read_geoheader(state, field_names):
+    """Generator that yields the geoheader rows for the supplied state
+    from the geography file of each of the ACS geography groupings with
+    tiger_geoid populated and blank values converted to NULL"""
 
     # prep to populate tiger geoid column
-    field_names = [c.name for c in columns]
     geoid_ix = field_names.index(GEOID)
     component_ix = field_names.index('component')
     sumlevel_ix = field_names.index('sumlevel')
+    logrec_ix = field_names.index('logrecno')
     tiger_ix = field_names.index(TIGER_GEOID)
 
-    # these summary levels are excluded from the tiger_geoid because
-    # their values are not unique from each other, sumlevels 050 and 160
-    # also conflict with these, but remain unique if these are excluded
-    sumlev_exclude = [
-        '320', '610', '612',
-        '620', '622', '795',
-        '950', '960', '970'
-    ]
+    geo_csv = 'g{yr}{span}{state}.csv'.format(
+        yr=gv.acs_year, span=gv.span, state=state.lower())
 
-    # more info on summary levels here:
-    # http://www2.census.gov/programs-surveys/acs/summary_file/2014/
-    # documentation/tech_docs/ACS_2014_SF_5YR_Appendices.xls
+    # the geography file may be present in both groupings and the
+    # records within them can overlap, logical record numbers that have
+    # already been yielded are skipped so the primary key isn't violated
+    loaded_logrecs = set()
+    for geog in ACS_GEOGRAPHY:
+        geog_dir = join(gv.data_dir, geog.lower())
+        if not find_archive_member(geog_dir, geo_csv):
+            continue
 
-    geog_dir = join(gv.data_dir, ACS_GEOGRAPHY[0].lower())
-    for st in gv.states:
-        geo_csv = 'g{yr}{span}{state}.csv'.format(
-            yr=gv.acs_year, span=gv.span, state=st.lower()
-        )
-        with open(join(geog_dir, geo_csv)) as geo_data:
+        with open_archive_member(geog_dir, geo_csv) as geo_data:
             reader = csv.reader(geo_data)
             for row in reader:
+                logrec = row[logrec_ix]
+                if logrec in loaded_logrecs:
+                    continue
+                loaded_logrecs.add(logrec)
+
                 # a component value of '00' means total population, all
                 # other values are subsets of the population
                 tiger = None
                 comp, sumlev = row[component_ix], row[sumlevel_ix]
-                if comp == '00' and sumlev not in sumlev_exclude:
-                    tiger = (re.match('\w*US(\w*)', row[geoid_ix]).group(1))
+                if comp == '00' and sumlev not in TIGER_SUMLEV_EXCLUDE:
+                    tiger = TIGER_GEOID_REGEX.match(row[geoid_ix]).group(1)
 
                 row.insert(tiger_ix, tiger)
 
                 # null values come in from the csv as empty strings
                 # this converts them such that they will be NULL in
                 # the database
-                null_row = [None if v == '' else v for v in row]
-                table.insert(null_row).execute()
+                yield [None if v == '' else v for v in row]
 
 
 def create_acs_tables():
     """"""
 
-    acs_tables = dict()
+    create_time = time.time()
+    catalog = get_selected_catalog()
+    variants = get_variants()
+    gv.scrub_map = make_scrub_map()
+
+    # the parquet loader doesn't touch the database, the tables are only
+    # used to define the files' schemas and there are no views
+    to_database = gv.loader != 'parquet'
+
+    # the cell types are needed to create the tables, tables that exist
+    # already keep the types they were created with
+    if gv.cell_type != 'numeric':
+        print '\nsampling sequence files to choose cell types...'
+        with metrics.phase('sample', schema=gv.metadata.schema) as tracker:
+            gv.cell_types, tracker.rows = sample_cell_types(catalog)
+
+    print '\ncreating acs tables...'
+
+    # when resuming tables that were created by the previous run are
+    # reused, their names are fetched at once rather than checking for
+    # each table individually
+    existing = set()
+    if gv.resume or gv.refresh or gv.add_states:
+        existing.update(gv.engine.table_names(schema=gv.metadata.schema))
+
+    # tables are grouped by the sequence file and variant (estimate or
+    # margin of error) that they're extracted from so that each
+    # sequence file only needs to be parsed once
+    seq_tables = defaultdict(lambda: defaultdict(list))
+    table_list = list()
+    view_list = list()
+    if gv.layout == 'sequence':
+        seq_variant = ''.join([fc for fc, _ in variants])
+        seq_entries = defaultdict(list)
+        for entry in catalog:
+            seq_entries[entry['sequence']].append(entry)
+
+        # both variants of a sequence are loaded by a single job, the
+        # views are kept out of the schema's metadata so that they're
+        # skipped when constraints are built and tables are analyzed
+        view_meta = MetaData(schema=gv.metadata.schema)
+        view_sql = list()
+        for seq, entries in sorted(seq_entries.items()):
+            entries.sort(key=itemgetter('start_ix'))
+            table = make_sequence_table(seq, entries)
+            if to_database and table.name not in existing:
+                table.create()
+            table_list.append(table)
+
+            for entry in entries:
+                seq_tables[seq][seq_variant].append(
+                    (table, entry['start_ix'], entry['cells']))
+
+                for file_char, name_ext in variants:
+                    view = make_acs_table(
+                        entry, entry['id'].lower() + name_ext, view_meta)
+                    view_sql.append(get_view_sql(view, table, file_char))
+                    view_list.append(view)
+
+        if to_database:
+            create_views(view_sql)
+    else:
+        for entry in catalog:
+            # there are two variants for each table one contains the
+            # actual data and other contains the corresponding margin of
+            # error for each cell, each is built directly from the
+            # catalog entry
+            for file_char, name_ext in variants:
+                table = make_acs_table(
+                    entry, entry['id'].lower() + name_ext, file_char=file_char)
+                if to_database and table.name not in existing:
+                    table.create()
+                table_list.append(table)
+
+                seq_tables[entry['sequence']][file_char].append(
+                    (table, entry['start_ix'], entry['cells']))
+
+    metrics.record('create_tables', time.time() - create_time,
+                   len(table_list) + len(view_list),
+                   schema=gv.metadata.schema)
+
+    print '\nloading acs tables, this will take awhile...'
+    print 'tables completed:'
+
+    # the work is divided into one job per sequence file variant, the
+    # jobs are stored on the global namespace so that forked worker
+    # processes inherit them and only need to be passed an index
+    gv.seq_jobs = list()
+    skipped = 0
+    for seq in sorted(seq_tables.keys()):
+        for file_char, tables in sorted(seq_tables[seq].items()):
+            if sequence_ledger_item(seq, file_char) in gv.completed:
+                skipped += 1
+            else:
+                gv.seq_jobs.append((seq, file_char, tables))
+
+    if skipped:
+        print 'skipping {} sequence files that were completed by a ' \
+              'previous run'.format(skipped)
+
+    tbl_count = 0
+    row_count = 0
+    start_time = time.time()
+    # connections can't be shared across a fork, so the parent's pool
+    # is emptied and each worker creates an engine of its own
+    if gv.workers > 1:
+        gv.engine.dispose()
+
+    seq_jobs = utils.map_jobs(
+        load_sequence_job, xrange(len(gv.seq_jobs)), gv.workers, init_worker)
+    for job_tables, job_rows in seq_jobs:
+        row_count += job_rows
+
+        # logging for user to keep track of progress
+        for _ in xrange(job_tables):
+            tbl_count += 1
+            if tbl_count % 50 == 0:
+                sys.stdout.write(str(tbl_count))
+            else:
+                sys.stdout.write('.')
+
+    utils.print_throughput(row_count, time.time() - start_time)
+
+    if not to_database:
+        return row_count
+
+    # states are only recorded once all of their sequences are loaded,
+    # this is what identifies them as present when states are added
+    for st in gv.states:
+        utils.mark_completed(
+            gv.engine, gv.metadata.schema, STATE_LEDGER.format(st))
+
+    # comments are applied in a single pass once the data has been
+    # loaded, the catalog has already decoded them from cp1252
+    if gv.comments and COMMENT_LEDGER not in gv.completed:
+        print '\nadding table and column comments...'
+        with metrics.phase('comments', schema=gv.metadata.schema) as tracker:
+            add_database_comments(table_list)
+            add_database_comments(view_list, relation='VIEW')
+            tracker.rows = len(table_list) + len(view_list)
+        utils.mark_completed(gv.engine, gv.metadata.schema, COMMENT_LEDGER)
+
+    return row_count
+
+
+def get_lookup_catalog():
+    """Returns the ACS lookup file parsed into a list of table entries,
+    the catalog is pickled to the data directory keyed by year and span
+    so the lookup file only needs to be parsed again when it changes"""
+
     lookup_path = join(gv.data_dir, gv.lookup_file)
+    catalog_path = join(gv.data_dir, CATALOG_FILE.format(
+        yr=gv.acs_year, span=gv.span))
+
+    if exists(catalog_path) and \
+            getmtime(catalog_path) >= getmtime(lookup_path):
+        with open(catalog_path, 'rb') as catalog_file:
+            version, catalog = cPickle.load(catalog_file)
+        if version == CATALOG_VERSION:
+            return catalog
+
+    catalog = parse_lookup_file(lookup_path)
+
+    # the file is moved into place once written so an interrupted run
+    # can't leave a truncated catalog behind
+    temp_path = '{}.tmp'.format(catalog_path)
+    with open(temp_path, 'wb') as catalog_file:
+        cPickle.dump((CATALOG_VERSION, catalog), catalog_file,
+                     cPickle.HIGHEST_PROTOCOL)
+    os.rename(temp_path, catalog_path)
+
+    return catalog
+
+
+def is_filtered():
+    """"""
+
+    return bool(gv.tables or gv.table_prefix or gv.subject)
+
+
+def get_selected_catalog():
+    """Returns the entries of the lookup catalog that match any of the
+    'tables', 'table_prefix' or 'subject' filters, every entry is
+    returned when no filters were supplied"""
+
+    catalog = get_lookup_catalog()
+    if not is_filtered():
+        return catalog
+
+    table_ids = {t.upper() for t in gv.tables}
+    prefixes = tuple([p.upper() for p in gv.table_prefix])
+    subjects = {s.strip().lower() for s in gv.subject}
+
+    unknown = table_ids - {e['id'] for e in catalog}
+    if unknown:
+        raise ValueError('tables {0} are not in {1}'.format(
+            ', '.join(sorted(unknown)), gv.lookup_file))
+
+    selected = [e for e in catalog
+                if e['id'] in table_ids or e['id'].startswith(prefixes)
+                or e['subject'].strip().lower() in subjects]
+    if not selected:
+        raise ValueError('none of the tables in {} match the supplied '
+                         'filters'.format(gv.lookup_file))
+
+    return selected
+
+
+def get_variants():
+    """Returns the (file character, name extension) of the variants that
+    are loaded, margins of error are left out if 'moe' is false"""
+
+    return [v for v in ACS_VARIANTS if gv.moe or v[1] != '_moe']
+
+
+def parse_lookup_file(lookup_path):
+    """Parse the lookup file that defines where each ACS table is found
+    within the sequence files, returns a list of dictionaries, sorted by
+    table id, that hold each table's id, sequence, start index, cell
+    count, subject, comment and the (line number, title) of each cell"""
+
+    acs_tables = dict()
 
     # this csv is encoded as cp1252 (aka windows-1252) this some of the
     # strings contain characters that need to be decoded as such
     with open(lookup_path) as lookup:
         reader = csv.DictReader(lookup)
         for row in reader:
+            title = row['Table Title'].decode('cp1252')
             if row['Start Position'].isdigit():
-                meta_table = {
-                    'name': row['Table ID'].lower(),
+                acs_tables[row['Table ID']] = {
+                    'id': row['Table ID'],
                     'sequence': row['Sequence Number'],
                     'start_ix': int(row['Start Position']) - 1,
                     'cells': int(''.join(
                         [i for i in row['Total Cells in Table']
                          if i.isdigit()])),
-                    'comment': row['Table Title'],
-                    'columns': [
-                        Column(
-                            name=k,
-                            type_=Text,
-                            doc=v,
-                            primary_key=True
-                        ) for k, v in ACS_PRIMARY_KEY.items()
-                    ]
+                    'subject': row['Subject Area'].decode('cp1252'),
+                    'comment': title,
+                    'lines': list()
                 }
-                acs_tables[row['Table ID']] = meta_table
 
             # the universe of the table subject matter is stored in a
             # separate row, add it to the table comment
             elif not row['Line Number'].strip() \
                     and not row['Start Position'].strip():
                 cur_tbl = acs_tables[row['Table ID']]
-                cur_tbl['comment'] += ', {}'.format(row['Table Title'])
+                cur_tbl['comment'] += u', {}'.format(title)
 
             # note that there are some rows with a line number of '0.5'
             # I'm not totally clear on what purpose they serve, but they
             # are not row in the tables and are being excluded here.
             elif row['Line Number'].isdigit():
                 cur_tbl = acs_tables[row['Table ID']]
-                cur_col = Column(
-                    name='f' + row['Line Number'],
-                    type_=Numeric,
-                    doc=row['Table Title']
-                )
-                cur_tbl['columns'].append(cur_col)
-
-    # a few values need to be scrubbed in the source data, this
-    # dictionary defines those mappings
+                cur_tbl['lines'].append((row['Line Number'], title))
+
+    return sorted(acs_tables.values(), key=itemgetter('id'))
+
+
+def make_acs_table(entry, name, metadata=None, file_char=None):
+    """Returns a table object for the supplied lookup catalog entry, new
+    column objects are created for each call so the estimate and margin
+    of error variants don't share any, the cells are typed for the
+    variant indicated by file_char or as numeric if it's None"""
+
+    columns = make_key_columns()
+    if gv.cell_type == 'array' and file_char:
+        columns.append(make_array_column(entry, file_char, ARRAY_COLUMN))
+    else:
+        for line, title in entry['lines']:
+            columns.append(Column(
+                name='f' + line,
+                type_=get_cell_type(entry, file_char, line),
+                doc=title))
+
+    return Table(
+        name,
+        metadata if metadata is not None else gv.metadata,
+        *columns,
+        info={'comment': entry['comment']},
+        **get_partition_kwargs())
+
+
+def make_sequence_table(sequence, entries):
+    """Returns a table object that holds the estimate and margin of
+    error cells of every table in the supplied sequence, the columns of
+    each ACS table are named with its id, the variant's file character
+    and the line number (b01001_e1, b01001_m1, etc.)"""
+
+    columns = make_key_columns()
+    for entry in entries:
+        for file_char, _ in get_variants():
+            prefix = '{0}_{1}'.format(entry['id'].lower(), file_char)
+            if gv.cell_type == 'array':
+                columns.append(make_array_column(entry, file_char, prefix))
+                continue
+
+            for line, title in entry['lines']:
+                columns.append(Column(
+                    name=prefix + line,
+                    type_=get_cell_type(entry, file_char, line),
+                    doc=title))
+
+    if len(columns) > MAX_COLUMNS:
+        raise ValueError(
+            'sequence {0} has {1} columns which exceeds the postgres '
+            'limit of {2}, use the "table" layout'.format(
+                sequence, len(columns), MAX_COLUMNS))
+
+    table_ids = ', '.join([e['id'] for e in entries])
+    return Table(
+        SEQUENCE_TABLE.format(sequence),
+        gv.metadata,
+        *columns,
+        info={'comment': u'Estimates and margins of error of ACS sequence '
+                         u'{0}, tables: {1}'.format(sequence, table_ids)},
+        **get_partition_kwargs())
+
+
+class CellArray(ARRAY):
+    """Array type whose values are passed to the database as postgres
+    array literals, see pack_cells, so that the same values can be
+    written by both loaders"""
+
+    def bind_processor(self, dialect):
+        return None
+
+
+def make_array_column(entry, file_char, name):
+    """Returns a column that holds every cell of one variant of an ACS
+    table as an array, the elements are in line number order and have
+    the widest of the types chosen for the cells"""
+
+    cell_types = {get_cell_type(entry, file_char, line)
+                  for line, _ in entry['lines']}
+    if cell_types <= {Integer, BigInteger}:
+        element_type = BigInteger if BigInteger in cell_types else Integer
+    elif cell_types <= {Integer, REAL}:
+        element_type = REAL
+    else:
+        element_type = DOUBLE_PRECISION
+
+    # the array index of each cell is included in its comment
+    doc = u'; '.join([u'[{0}] {1}'.format(ix + 1, title)
+                      for ix, (_, title) in enumerate(entry['lines'])])
+    return Column(name=name, type_=CellArray(element_type), doc=doc)
+
+
+def get_cell_type(entry, file_char, line):
+    """"""
+
+    if gv.cell_type == 'numeric' or file_char is None:
+        return Numeric
+    else:
+        return gv.cell_types[(entry['id'], file_char, line)]
+
+
+def sample_cell_types(catalog):
+    """Returns a dictionary that maps the (table id, file character, line
+    number) of every cell to the most compact type that holds the values
+    sampled from the sequence files of each state along with the number
+    of rows sampled, the cells of tables whose titles describe them as
+    aggregates are at least bigint"""
+
+    seq_entries = defaultdict(list)
+    for entry in catalog:
+        seq_entries[entry['sequence']].append(entry)
+
+    # each sequence is sampled by a job of its own, the jobs are stored on
+    # the global namespace so that forked workers inherit them, see
+    # create_acs_tables
+    gv.sample_jobs = sorted(seq_entries.items())
+
+    cell_types = dict()
+    row_count = 0
+    for seq_types, seq_rows in utils.map_jobs(
+            sample_sequence_job, xrange(len(gv.sample_jobs)), gv.workers):
+        cell_types.update(seq_types)
+        row_count += seq_rows
+
+    return cell_types, row_count
+
+
+def sample_sequence_job(job_ix):
+    """Returns the types chosen for the cells of both variants of a
+    sequence, see sample_cell_types, and the number of rows sampled, the
+    rows of each state are streamed and only running statistics of each
+    cell are kept"""
+
+    seq, entries = gv.sample_jobs[job_ix]
+    cell_types = dict()
+    row_count = 0
+    for file_char, _ in get_variants():
+        cells = [(entry, line, entry['start_ix'] + lx, CellStats())
+                 for entry in entries
+                 for lx, (line, _) in enumerate(entry['lines'])]
+
+        for st in gv.states:
+            for row in read_sequence(
+                    seq, file_char, st, gv.scrub_map, SAMPLE_ROWS):
+                for _, _, cx, stats in cells:
+                    stats.add(row[cx])
+                row_count += 1
+
+        for entry, line, _, stats in cells:
+            aggregate = 'aggregate' in entry['comment'].lower()
+            cell_types[(entry['id'], file_char, line)] = \
+                choose_cell_type(stats, aggregate)
+
+    return cell_types, row_count
+
+
+class CellStats(object):
+    """Running statistics of the values sampled from a cell, these are
+    all that choose_cell_type needs so the values themselves aren't
+    kept"""
+
+    def __init__(self):
+        self.count = 0
+        self.integer = True
+        self.magnitude = 0
+        self.digits = 0
+
+    def add(self, value):
+        # empty values have been scrubbed to None and '.' to 0
+        if value is None:
+            return
+
+        value = str(value).lstrip('-')
+        self.count += 1
+        if self.integer and value.isdigit():
+            self.magnitude = max(self.magnitude, int(value))
+        else:
+            self.integer = False
+
+        # leading and trailing zeros aren't significant to a float
+        self.digits = max(
+            self.digits, len(value.replace('.', '').strip('0')))
+
+
+def choose_cell_type(stats, aggregate=False):
+    """Returns the most compact type that can hold the values described
+    by the supplied CellStats, see SAMPLE_ROWS"""
+
+    if not stats.count:
+        return DOUBLE_PRECISION
+
+    if stats.integer:
+        if aggregate or stats.magnitude * INTEGER_HEADROOM > 2 ** 31 - 1:
+            return BigInteger
+        else:
+            return Integer
+
+    if stats.digits <= REAL_DIGITS and not aggregate:
+        return REAL
+    else:
+        return DOUBLE_PRECISION
+
+
+def pack_cells(cells):
+    """Returns the supplied cells as a postgres array literal, or as a
+    list for the parquet loader"""
+
+    if gv.loader == 'parquet':
+        return cells
+
+    return '{' + ','.join(['NULL' if c is None else str(c)
+                           for c in cells]) + '}'
+
+
+def make_key_columns():
+    """Returns the primary key columns that every ACS table has along
+    with the foreign key that they form to the geoheader"""
+
+    columns = [
+        Column(
+            name=k,
+            type_=Text,
+            doc=v,
+            primary_key=not gv.defer_constraints
+        ) for k, v in ACS_PRIMARY_KEY.items()
+    ]
+
+    # the stusab, logrecno combo is a primary key to all tables and
+    # those two in geoheader serve as a foreign key to the others, the
+    # foreign key is omitted when partitioning as it would prevent the
+    # partitions of geoheader from being swapped
+    if not (gv.defer_constraints or gv.partition):
+        columns.append(ForeignKeyConstraint(
+            ACS_PRIMARY_KEY.keys(),
+            ['{0}.{1}'.format(GEOHEADER, k) for k in ACS_PRIMARY_KEY.keys()]
+        ))
+
+    return columns
+
+
+def get_partition_kwargs():
+    """Returns the keyword arguments that make a table partitioned by
+    state when partitioning is enabled"""
+
+    if gv.partition:
+        return {'postgresql_partition_by': PARTITION_BY}
+    else:
+        return dict()
+
+
+def is_partitioned_schema():
+    """Returns True if geoheader and any of the tables of the selected
+    layout already exist as partitioned tables in the schema, a previous
+    load may have been filtered to other tables, so the selected ones
+    aren't checked for"""
+
+    if not is_partitioned(GEOHEADER):
+        return False
+
+    table_name = gv.engine.execute(text(
+        "SELECT c.relname FROM pg_class c "
+        "JOIN pg_namespace n ON n.oid = c.relnamespace "
+        "WHERE n.nspname = :schema AND c.relkind = 'p' "
+        "AND c.relname != :geoheader "
+        "AND (c.relname LIKE :pattern) = :sequence LIMIT 1;"),
+        schema=gv.metadata.schema, geoheader=GEOHEADER,
+        pattern=SEQUENCE_TABLE.format('%'),
+        sequence=gv.layout == 'sequence').scalar()
+
+    return table_name is not None
+
+
+def is_partitioned(table_name):
+    """"""
+
+    relkind = gv.engine.execute(text(
+        "SELECT c.relkind FROM pg_class c "
+        "JOIN pg_namespace n ON n.oid = c.relnamespace "
+        "WHERE n.nspname = :schema AND c.relname = :table;"),
+        schema=gv.metadata.schema, table=table_name).scalar()
+
+    return relkind == 'p'
+
+
+def create_stage_table(table, state):
+    """Create an empty staging table for the supplied state that has the
+    same columns and indices as the partitioned table and a check
+    constraint that matches the state's partition bounds, which allows
+    it to be attached without being scanned, returns a table object for
+    the staging table"""
+
+    part_name = PARTITION_TABLE.format(table=table.name, state=state.lower())
+    stage_name = STAGE_TABLE.format(part_name)
+    stage_path = '{0}.{1}'.format(table.schema, stage_name)
+
+    # any staging table left by an interrupted run is discarded
+    with gv.engine.begin() as connection:
+        connection.execute('DROP TABLE IF EXISTS {};'.format(stage_path))
+        connection.execute(
+            "CREATE TABLE {0} (LIKE {1} INCLUDING DEFAULTS INCLUDING INDEXES, "
+            "CHECK (stusab = '{2}'));".format(
+                stage_path, table.fullname, state))
+
+    return Table(
+        stage_name,
+        MetaData(),
+        *[Column(c.name, c.type) for c in table.columns],
+        schema=table.schema)
+
+
+def attach_stage_tables(tables, state):
+    """Swap the staging tables of the supplied state in as the state's
+    partition of each of the tables, this happens in a single
+    transaction so readers see either the old rows or the new ones"""
+
+    schema = gv.metadata.schema
+    parts = dict()
+    for table in tables:
+        part_name = PARTITION_TABLE.format(
+            table=table.name, state=state.lower())
+        parts[STAGE_TABLE.format(part_name)] = part_name
+
+    # indices are named after the table they were created on, they're
+    # renamed along with the staging table so that the next staging
+    # table of this state can reuse the names
+    stage_indexes = gv.engine.execute(text(
+        "SELECT tablename, indexname FROM pg_indexes "
+        "WHERE schemaname = :schema AND tablename IN :tables;"),
+        schema=schema, tables=tuple(parts.keys())).fetchall()
+
+    with gv.engine.begin() as connection:
+        for table in tables:
+            part_name = PARTITION_TABLE.format(
+                table=table.name, state=state.lower())
+            stage_name = STAGE_TABLE.format(part_name)
+            connection.execute(
+                'DROP TABLE IF EXISTS {0}.{1};'.format(schema, part_name))
+            connection.execute('ALTER TABLE {0}.{1} RENAME TO {2};'.format(
+                schema, stage_name, part_name))
+
+            for tbl_name, index in stage_indexes:
+                if tbl_name == stage_name and index.startswith(stage_name):
+                    connection.execute(
+                        'ALTER INDEX {0}.{1} RENAME TO {2}{3};'.format(
+                            schema, index, part_name,
+                            index[len(stage_name):]))
+
+            connection.execute(
+                "ALTER TABLE {0} ATTACH PARTITION {1}.{2} "
+                "FOR VALUES IN ('{3}');".format(
+                    table.fullname, schema, part_name, state))
+
+
+def get_view_sql(view, seq_table, file_char):
+    """Returns the statement that creates a view, shaped like the table
+    of the 'table' layout, over the columns of one variant of an ACS
+    table within a sequence table"""
+
+    table_id = view.name.split('_')[0]
+    select_list = list()
+    element_ix = 0
+    for c in view.columns:
+        if c.name in ACS_PRIMARY_KEY:
+            select_list.append(c.name)
+        elif gv.cell_type == 'array':
+            element_ix += 1
+            select_list.append('{0}_{1}[{2}] AS {3}'.format(
+                table_id, file_char, element_ix, c.name))
+        else:
+            select_list.append('{0}_{1}{2} AS {3}'.format(
+                table_id, file_char, c.name[1:], c.name))
+
+    return 'CREATE OR REPLACE VIEW {0} AS SELECT {1} FROM {2};'.format(
+        view.fullname, ', '.join(select_list), seq_table.fullname)
+
+
+def create_views(view_sql):
+    """Execute the supplied view statements, many views are created by
+    each transaction to limit the number of round trips"""
+
+    for batch in utils.iter_chunks(view_sql, VIEW_BATCH):
+        with gv.engine.begin() as connection:
+            connection.execute('\n'.join(batch))
+
+
+def get_new_states():
+    """Returns the supplied states that haven't been completely loaded
+    into the schema, states are identified by their entries in the
+    ledger or, for schemas that predate those, by the geoheader"""
+
+    schema = gv.metadata.schema
+    engine = gv.engine
+    ledger, geoheader = engine.execute(text(
+        "SELECT to_regclass(:ledger), to_regclass(:geoheader);"),
+        ledger='{0}.{1}'.format(schema, LEDGER),
+        geoheader='{0}.{1}'.format(schema, GEOHEADER)).first()
+
+    loaded = set()
+    if ledger:
+        state_prefix = STATE_LEDGER.format('')
+        loaded.update([i[len(state_prefix):]
+                       for i in utils.get_completed(engine, schema)
+                       if i.startswith(state_prefix)])
+    if geoheader and not loaded:
+        loaded.update([r[0] for r in engine.execute(
+            'SELECT DISTINCT stusab FROM {0}.{1};'.format(schema, GEOHEADER))])
+
+    new_states = [st for st in gv.states if st not in loaded]
+    skipped = sorted(set(gv.states) - set(new_states))
+    if skipped:
+        print 'states already loaded into {0}: {1}'.format(
+            schema, ', '.join(skipped))
+
+    # rows of a new state that are already in the geoheader were written
+    # by an interrupted run, which must be resumed to remove them
+    if geoheader and new_states and not (gv.resume or gv.partition):
+        partial = [r[0] for r in engine.execute(
+            text('SELECT DISTINCT stusab FROM {0}.{1} '
+                 'WHERE stusab IN :states;'.format(schema, GEOHEADER)),
+            states=tuple(new_states))]
+        if partial:
+            raise ValueError(
+                'states {0} were partially loaded by an interrupted run, use '
+                'the "resume" flag to complete them'.format(
+                    ', '.join(partial)))
+
+    return new_states
+
+
+def get_other_states():
+    """Returns the states that the ledger records as loaded that aren't
+    among the supplied states, their rows must be kept when resuming"""
+
+    state_prefix = STATE_LEDGER.format('')
+    loaded = {i[len(state_prefix):] for i in gv.completed
+              if i.startswith(state_prefix)}
+
+    return loaded - set(gv.states)
+
+
+def clear_state_ledger():
+    """Remove the ledger entries of the states that are being loaded
+    into an existing schema, along with those of every sequence since
+    each sequence job covers all of the supplied states"""
+
+    state_items = {'{0}:{1}'.format(GEOHEADER, st) for st in gv.states}
+    cleared = {i for i in gv.completed
+               if i in state_items or i.startswith('sequence:')}
+
+    utils.clear_completed(gv.engine, gv.metadata.schema, cleared)
+    gv.completed -= cleared
+
+
+def init_worker():
+    """"""
+
+    gv.engine = create_engine(gv.engine.url)
+
+
+def load_sequence_job(job_ix):
+    """"""
+
+    seq, file_char, tables = gv.seq_jobs[job_ix]
+
+    # any rows in these tables were written by a run that was interrupted
+    # before the sequence was completed and must be cleared, partitions
+    # are only swapped in once complete so don't need to be, when adding
+    # states, or resuming a run that added them without the flag, only
+    # the rows of the supplied states are removed
+    if gv.resume and not gv.partition:
+        table_paths = sorted({t.fullname for t, _, _ in tables})
+        with gv.engine.begin() as connection:
+            if gv.add_states or get_other_states():
+                for table_path in table_paths:
+                    connection.execute(
+                        text('DELETE FROM {} WHERE stusab IN :states;'.format(
+                            table_path)),
+                        states=tuple(gv.states))
+            else:
+                connection.execute(
+                    'TRUNCATE {};'.format(', '.join(table_paths)))
+
+    with metrics.phase('load', sequence=seq, variant=file_char) as tracker:
+        if gv.layout == 'sequence':
+            tracker.rows = load_wide_sequence(seq, tables, gv.scrub_map)
+        else:
+            tracker.rows = load_sequence(
+                seq, file_char, tables, gv.scrub_map)
+    row_count = tracker.rows
+
+    # the parquet files are only valid once their writers are closed
+    if gv.loader == 'parquet':
+        parquet.close_writers()
+    else:
+        utils.mark_completed(gv.engine, gv.metadata.schema,
+                             sequence_ledger_item(seq, file_char))
+
+    return len(tables), row_count
+
+
+def sequence_ledger_item(sequence, file_char):
+    """"""
+
+    return 'sequence:{0}{1}'.format(sequence, file_char)
+
+
+def make_scrub_map():
+    """A few values need to be scrubbed in the source data, this
+    returns a dictionary that defines those mappings"""
+
     scrub_map = {k.lower(): k for k in gv.state_names.keys()}
     scrub_map.update({
         '': None,
         '.': 0
     })
 
-    # the stusab, logrecno combo is a primary key to all tables and
-    # those two in geoheader serve as a foreign key to the others
-    stusab_ix, logrec_ix = 2, 5
-    foreign_key = ForeignKeyConstraint(
-        ACS_PRIMARY_KEY.keys(),
-        ['{0}.{1}'.format(GEOHEADER, k) for k in ACS_PRIMARY_KEY.keys()]
-    )
+    return scrub_map
 
-    print '\ncreating acs tables, this will take awhile...'
-    print 'tables completed:'
 
-    tbl_count = 0
-    for mt in acs_tables.values():
-        # columns and foreign keys are accepted as *args for table object
-        mt['columns'].append(deepcopy(foreign_key))
-
-        # there are two variants for each table one contains the actual
-        # data and other contains the corresponding margin of error for
-        # each cell
-        table_variant = {
-            'standard': {
-                'file_char': 'e',
-                'name_ext': '',
-                'meta_table': mt
-            },
-            'margin of error': {
-                'file_char': 'm',
-                'name_ext': '_moe',
-                'meta_table': deepcopy(mt)}}
-
-        for tv in table_variant.values():
-            mtv = tv['meta_table']
-            mtv['name'] += tv['name_ext']
-
-            table = Table(
-                mtv['name'],
-                gv.metadata,
-                *mtv['columns'],
-                info=mtv['comment'])
-            table.create()
-            add_database_comments(table, 'cp1252')
-
-            # create a list of the indices that for the columns that will
-            # be extracted from the defined sequence for the current table
-            columns = [stusab_ix, logrec_ix]
-            columns.extend(
-                xrange(mtv['start_ix'], mtv['start_ix'] + mtv['cells'])
-            )
-
-            memory_tbl = list()
-            for st in gv.states:
-                seq_name = '{type}{yr}{span}{state}{seq}000.txt'.format(
-                    type=tv['file_char'], yr=gv.acs_year, span=gv.span,
-                    state=st.lower(), seq=mtv['sequence'])
-
-                for geog in ACS_GEOGRAPHY:
-                    seq_path = join(gv.data_dir, geog, seq_name)
-                    with open(seq_path) as seq:
-                        reader = csv.reader(seq)
-                        for row in reader:
-                            tbl_ix = 0
-                            tbl_row = dict()
-                            for ix in columns:
-                                try:
-                                    row[ix] = scrub_map[row[ix]]
-                                except KeyError:
-                                    pass
-
-                                field_name = mtv['columns'][tbl_ix].name
-                                tbl_row[field_name] = row[ix]
-                                tbl_ix += 1
-
-                            memory_tbl.append(tbl_row)
-
-            # this type bulk of insert uses sqlalchemy core and
-            # is faster than alternative methods see details here:
-            # http://docs.sqlalchemy.org/en/rel_0_8/faq.html#
-            # i-m-inserting-400-000-rows-with-the-orm-and-it-s-really-slow
-            gv.engine.execute(table.insert(), memory_tbl)
-
-            # logging for user to keep track of progress
-            tbl_count += 1
-            if tbl_count % 50 == 0:
-                sys.stdout.write(str(tbl_count))
+def read_sequence(sequence, file_char, state, scrub_map, max_rows=None):
+    """Generator that yields the scrubbed rows of the estimate ('e') or
+    margin of error ('m') file of the supplied sequence and state for
+    each of the ACS geography groupings, at most max_rows are read from
+    each grouping if it's supplied"""
+
+    seq_name = '{type}{yr}{span}{state}{seq}000.txt'.format(
+        type=file_char, yr=gv.acs_year, span=gv.span,
+        state=state.lower(), seq=sequence)
+
+    for geog in ACS_GEOGRAPHY:
+        geog_dir = join(gv.data_dir, geog.lower())
+        with open_archive_member(geog_dir, seq_name) as seq:
+            reader = csv.reader(seq)
+            for row in islice(reader, max_rows):
+                yield [scrub_map.get(v, v) for v in row]
+
+
+def load_sequence(sequence, file_char, tables, scrub_map):
+    """Parse the sequence files for each state a single time and slice
+    out the columns of every table they contain, tables is a list of
+    (table, start index, cell count) tuples, returns the number of rows
+    written"""
+
+    # rows are streamed from the csv reader and flushed to the database
+    # every 'chunk_size' rows, so memory use is capped at one chunk per
+    # table in the sequence regardless of how many states are loaded
+    memory_tbls = defaultdict(list)
+    row_count = 0
+    chunk_count = 0
+    seq_rows = 0
+
+    # the time spent writing to the database is subtracted from the
+    # total so that the parse event only covers reading and slicing
+    start_time = time.time()
+    flush_seconds = 0
+    packed = gv.cell_type == 'array'
+    targets = tables
+    for st in gv.states:
+        # when partitioning each state's rows are written to staging
+        # tables that are swapped in once the state is complete
+        if gv.partition:
+            targets = [(create_stage_table(t, st), start_ix, cells)
+                       for t, start_ix, cells in tables]
+
+        for row in read_sequence(sequence, file_char, st, scrub_map):
+            primary_key = [row[SEQ_STUSAB_IX], row[SEQ_LOGREC_IX]]
+            for table, start_ix, cells in targets:
+                if packed:
+                    memory_tbls[table.name].append(primary_key + [
+                        pack_cells(row[start_ix: start_ix + cells])])
+                else:
+                    memory_tbls[table.name].append(
+                        primary_key + row[start_ix: start_ix + cells])
+
+            seq_rows += 1
+            chunk_count += 1
+            if chunk_count == gv.chunk_size:
+                flush_start = time.time()
+                row_count += flush_tables(targets, memory_tbls)
+                flush_seconds += time.time() - flush_start
+                chunk_count = 0
+
+        # the rows of each state are flushed once it's complete so that
+        # its partitions can be swapped in, or its parquet files closed
+        # rather than holding a file open per table for every state
+        if gv.partition or gv.loader == 'parquet':
+            flush_start = time.time()
+            row_count += flush_tables(targets, memory_tbls)
+            if gv.partition:
+                attach_stage_tables([t for t, _, _ in tables], st)
             else:
-                sys.stdout.write('.')
+                parquet.close_writers()
+            flush_seconds += time.time() - flush_start
+            chunk_count = 0
 
+    flush_start = time.time()
+    row_count += flush_tables(targets, memory_tbls)
+    flush_seconds += time.time() - flush_start
 
-def add_database_comments(table, encoding=None):
-    """Add comments to the supplied table and each of its columns, the
+    metrics.record(
+        'parse', time.time() - start_time - flush_seconds, seq_rows,
+        sequence=sequence, variant=file_char)
+
+    return row_count
+
+
+def load_wide_sequence(sequence, tables, scrub_map):
+    """Load the estimate and margin of error files of the supplied
+    sequence into its sequence table, tables is a list of (sequence
+    table, start index, cell count) tuples for each ACS table within the
+    sequence, returns the number of rows written"""
+
+    # there's a single target table so the rows of each state are
+    # streamed to it without being buffered
+    seq_table = tables[0][0]
+    row_count = 0
+    for st in gv.states:
+        target = seq_table
+        if gv.partition:
+            target = create_stage_table(seq_table, st)
+
+        wide_rows = read_wide_sequence(sequence, st, scrub_map, tables)
+        row_count += utils.load_rows(
+            gv.engine, target, wide_rows, gv.loader, gv.chunk_size)
+
+        if gv.partition:
+            attach_stage_tables([seq_table], st)
+        elif gv.loader == 'parquet':
+            parquet.close_writers()
+
+    return row_count
+
+
+def read_wide_sequence(sequence, state, scrub_map, tables):
+    """Generator that reads the estimate and margin of error files of a
+    sequence in lockstep and yields rows that hold the cells of both
+    variants of each ACS table side by side, only the estimates are read
+    if margins of error are left out"""
+
+    variant_rows = [read_sequence(sequence, fc, state, scrub_map)
+                    for fc, _ in get_variants()]
+    packed = gv.cell_type == 'array'
+
+    # the census bureau writes the records of the two files in the same
+    # order, this is verified on the primary key of each pair
+    for rows in izip_longest(*variant_rows):
+        if None in rows or any(
+                [r[SEQ_LOGREC_IX] != rows[0][SEQ_LOGREC_IX] or
+                 r[SEQ_STUSAB_IX] != rows[0][SEQ_STUSAB_IX] for r in rows]):
+            raise ValueError(
+                'the estimate and margin of error files of sequence {0} '
+                'for {1} are not aligned'.format(sequence, state))
+
+        row = [rows[0][SEQ_STUSAB_IX], rows[0][SEQ_LOGREC_IX]]
+        for _, start_ix, cells in tables:
+            for variant_row in rows:
+                if packed:
+                    row.append(pack_cells(
+                        variant_row[start_ix: start_ix + cells]))
+                else:
+                    row.extend(variant_row[start_ix: start_ix + cells])
+
+        yield row
+
+
+def flush_tables(tables, memory_tbls):
+    """Write the rows buffered for each table to the database and empty
+    the buffers, returns the number of rows written"""
+
+    # rows are ordered like the table's columns so they can be streamed
+    # with COPY, the 'insert' loader is slower but is retained as a
+    # fallback
+    row_count = 0
+    for table, _, _ in tables:
+        tbl_rows = memory_tbls[table.name]
+        if tbl_rows:
+            row_count += utils.load_rows(
+                gv.engine, table, tbl_rows, gv.loader, gv.chunk_size)
+            memory_tbls[table.name] = list()
+
+    return row_count
+
+
+def add_deferred_constraints():
+    """Build the primary keys, foreign keys and the tiger_geoid index
+    that are omitted from the tables when constraints are deferred, this
+    work is spread across 'workers' connections and any constraints
+    that fail to build or validate are reported"""
+
+    if CONSTRAINT_LEDGER in gv.completed:
+        return
+
+    print '\nadding primary keys, foreign keys and indices...'
+    start_time = time.time()
+
+    # constraints that were completed by an interrupted run are skipped,
+    # foreign keys may have been added without being validated
+    schema = gv.metadata.schema
+    gv.constraints = dict(gv.engine.execute(
+        "SELECT c.conname, c.convalidated FROM pg_constraint c "
+        "JOIN pg_namespace n ON n.oid = c.connamespace "
+        "WHERE n.nspname = '{0}' "
+        "UNION ALL "
+        "SELECT indexname, true FROM pg_indexes "
+        "WHERE schemaname = '{0}';".format(schema)).fetchall())
+
+    # names match those that postgres and sqlalchemy generate when
+    # constraints are created along with the tables
+    geoheader = gv.metadata.tables['{0}.{1}'.format(schema, GEOHEADER)]
+    pk_str = ', '.join(ACS_PRIMARY_KEY.keys())
+    tiger_ix = 'ix_{0}_{1}_{2}'.format(schema, GEOHEADER, TIGER_GEOID)
+    geo_steps = [
+        ('{}_pkey'.format(GEOHEADER),
+         'ALTER TABLE {0} ADD CONSTRAINT {1}_pkey PRIMARY KEY ({2});'.format(
+             geoheader.fullname, GEOHEADER, pk_str)),
+        (tiger_ix,
+         'CREATE {0}INDEX {1} ON {2} ({3});'.format(
+             '' if gv.partition else 'UNIQUE ', tiger_ix,
+             geoheader.fullname, TIGER_GEOID))
+    ]
+
+    # foreign keys are added as 'NOT VALID' and then validated in a
+    # separate step, adding a foreign key locks the referenced table
+    # against other foreign key additions, but validation doesn't so the
+    # expensive part of the work can run concurrently
+    table_steps = list()
+    for table in sorted(gv.metadata.tables.values(), key=attrgetter('name')):
+        if table.name in (GEOHEADER, LEDGER):
+            continue
+
+        pk_name = '{}_pkey'.format(table.name)
+        fk_name = '{0}_{1}_fkey'.format(
+            table.name, '_'.join(ACS_PRIMARY_KEY.keys()))
+        table_steps.append([
+            (pk_name,
+             'ALTER TABLE {0} ADD CONSTRAINT {1} PRIMARY KEY ({2});'.format(
+                 table.fullname, pk_name, pk_str))
+        ])
+
+        # partitioned tables don't have foreign keys, see make_key_columns
+        if not gv.partition:
+            table_steps[-1].extend([
+                (fk_name,
+                 'ALTER TABLE {0} ADD CONSTRAINT {1} FOREIGN KEY ({2}) '
+                 'REFERENCES {3} ({2}) NOT VALID;'.format(
+                     table.fullname, fk_name, pk_str, geoheader.fullname)),
+                (fk_name,
+                 'ALTER TABLE {0} VALIDATE CONSTRAINT {1};'.format(
+                     table.fullname, fk_name))
+            ])
+
+    # the geoheader must be complete before anything can reference it
+    gv.constraint_engine = create_engine(
+        gv.engine.url, pool_size=max(gv.workers, 1))
+    failures = apply_constraint_steps(geo_steps)
+    if not failures:
+        pool = ThreadPool(max(gv.workers, 1))
+        try:
+            for table_failures in pool.imap(
+                    apply_constraint_steps, table_steps):
+                failures.extend(table_failures)
+        finally:
+            pool.close()
+            pool.join()
+
+    gv.constraint_engine.dispose()
+    seconds = time.time() - start_time
+    metrics.record('constraints', seconds, len(table_steps), schema=schema)
+    print 'completed in {:,.1f} seconds'.format(seconds)
+
+    if failures:
+        print '\nthe following constraints failed to build or validate:'
+        for name, error in failures:
+            print '{0}: {1}'.format(name, error)
+    else:
+        utils.mark_completed(gv.engine, schema, CONSTRAINT_LEDGER)
+
+
+def apply_constraint_steps(steps):
+    """Execute the supplied (constraint name, sql) steps in order, each
+    in its own transaction, the first step that fails halts the rest and
+    a list of (constraint name, error) tuples is returned"""
+
+    for name, sql in steps:
+        # validated constraints and indices built by an earlier run
+        # don't need to be recreated
+        if gv.constraints.get(name):
+            continue
+        elif name in gv.constraints and 'VALIDATE' not in sql:
+            continue
+
+        try:
+            with gv.constraint_engine.begin() as connection:
+                connection.execute(sql)
+        except sqlalchemy.exc.DBAPIError as e:
+            return [(name, str(e.orig).strip())]
+
+    return list()
+
+
+def optimize_acs_tables():
+    """Refresh the planner statistics of every table in the ACS schema,
+    the tables are analyzed in batches that each run in their own
+    transaction and the time taken by each batch is reported"""
+
+    print '\noptimizing acs tables...'
+    schema = gv.metadata.schema
+    tables = sorted(gv.metadata.tables.values(), key=attrgetter('name'))
+
+    # analyze takes a lock on each table and each of its partitions and
+    # holds them until the transaction ends, so the batches are made
+    # smaller when the tables are partitioned, see drop_create_acs_schema
+    part_count = gv.engine.execute(
+        "SELECT count(*) FROM pg_class c "
+        "JOIN pg_namespace n ON n.oid = c.relnamespace "
+        "WHERE n.nspname = '{}' AND c.relispartition;".format(
+            schema)).scalar()
+    step = max(ANALYZE_BATCH * len(tables) /
+               max(len(tables) + part_count, 1), 1)
+
+    for start_ix in xrange(0, len(tables), step):
+        batch = tables[start_ix: start_ix + step]
+        utils.run_timed(
+            gv.engine, '{0}: analyze {1}-{2}'.format(
+                schema, batch[0].name, batch[-1].name),
+            ['ANALYZE {};'.format(t.fullname) for t in batch])
+
+
+def add_database_comments(tables, relation='TABLE'):
+    """Add comments to the supplied tables and each of their columns, the
     meaning of each table and column in the ACS can be difficult to
-    ascertain and this should help to clarify"""
+    ascertain and this should help to clarify, relation must be 'VIEW'
+    if the tables are views"""
 
     schema = gv.metadata.schema
-    with gv.engine.begin() as connection:
-        # using postgres dollar quotes on comment as some of the
-        # comments contain single quotes
-        tbl_comment_sql = "COMMENT ON TABLE " \
-                          "{schema}.{table} IS $${comment}$$;".format(
-                                schema=schema, table=table.name,
-                                comment=table.info)
-        connection.execute(tbl_comment_sql)
-
-        col_template = r"COMMENT ON COLUMN " \
-                       "{schema}.{table}.{column} IS $${comment}$$;"
-        for c in table.columns:
-            # sqlalchemy throws an error when there is a '%' sign in a
-            # query thus they must be escaped with a second '%%' sign
-            col_comment_sql = col_template.format(
-                schema=schema, table=table.name,
-                column=c.name, comment=c.doc.replace('%', '%%'))
-
-            # the files from which comments are derived have non-ascii
-            # encoded files and thus need to be appropriately decoded
-            # as such
-            if encoding:
-                col_comment_sql = col_comment_sql.decode(encoding)
-
-            connection.execute(col_comment_sql)
+
+    # using postgres dollar quotes on comment as some of the comments
+    # contain single quotes
+    tbl_template = 'COMMENT ON ' + relation + \
+                   ' {schema}.{table} IS $${comment}$$;'
+    col_template = 'COMMENT ON COLUMN ' \
+                   '{schema}.{table}.{column} IS $${comment}$$;'
+
+    # the comments of many tables are sent to the database as a single
+    # multi-statement payload and each payload is its own transaction,
+    # psycopg2 is used directly so that '%' signs in the comments don't
+    # have to be escaped
+    connection = gv.engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        for batch in utils.iter_chunks(tables, COMMENT_BATCH):
+            statements = list()
+            for table in batch:
+                statements.append(tbl_template.format(
+                    schema=schema, table=table.name,
+                    comment=table.info['comment']))
+
+                for c in table.columns:
+                    statements.append(col_template.format(
+                        schema=schema, table=table.name,
+                        column=c.name, comment=c.doc))
+
+            cursor.execute('\n'.join(statements))
+            connection.commit()
+    finally:
+        connection.close()
+
+
+def write_parquet_tables():
+    """Write geoheader and the selected ACS tables to parquet files, only
+    the partitions of those tables are replaced so the files of tables
+    that a filtered run doesn't select are kept"""
+
+    parquet.configure(gv.output_dir)
+    parquet.clear_partitions(
+        gv.metadata.schema, get_table_names(), gv.states)
+    gv.completed = set()
+    create_geoheader()
+    create_acs_tables()
+
+
+def get_table_names():
+    """Returns the names of the tables that are loaded, geoheader along
+    with either the sequence tables or the selected ACS tables"""
+
+    catalog = get_selected_catalog()
+    if gv.layout == 'sequence':
+        names = sorted({SEQUENCE_TABLE.format(e['sequence'])
+                        for e in catalog})
+    else:
+        names = [e['id'].lower() + name_ext for e in catalog
+                 for _, name_ext in get_variants()]
+
+    return [GEOHEADER] + names
 
 
 def process_options(arg_list=None):
@@ -394,11 +1570,105 @@ def process_options(arg_list=None):
     parser.add_argument(
         '-l', '--span', '--length',
         default=5,
+        type=int,
         choices=ACS_SPANS,
         help='number of years that ACS data product covers'
     )
+    parser.add_argument(
+        '-dc', '--defer_constraints',
+        action='store_true',
+        help='create tables without primary keys, foreign keys or indices '
+             'and build them once all data has been loaded, the constraints '
+             'are built in parallel when "workers" is greater than one'
+    )
+    parser.add_argument(
+        '-nc', '--no_comments',
+        default=True,
+        dest='comments',
+        action='store_false',
+        help='by default comments describing each table and column are '
+             'added once the data is loaded, use this flag to skip them'
+    )
+    parser.add_argument(
+        '-tb', '--tables',
+        nargs='+',
+        default=list(),
+        help='ids of the ACS tables to load (B01001, B19013, etc.), by '
+             'default every table is loaded, when this or any of the '
+             'other table filters are used only the tables that match at '
+             'least one of them are created and only the sequence files '
+             'they are found in are downloaded and read'
+    )
+    parser.add_argument(
+        '-tp', '--table_prefix',
+        nargs='+',
+        default=list(),
+        help='load the ACS tables whose ids begin with any of these '
+             'prefixes, for example "B19" or "C"'
+    )
+    parser.add_argument(
+        '-sa', '--subject',
+        nargs='+',
+        default=list(),
+        help='load the ACS tables in any of these subject areas of the '
+             'lookup file, for example "Income" (case insensitive)'
+    )
+    parser.add_argument(
+        '-nmoe', '--no_moe',
+        default=True,
+        dest='moe',
+        action='store_false',
+        help='by default a margin of error table (or columns with the '
+             '"sequence" layout) is loaded along with each table, use '
+             'this flag to load only the estimates'
+    )
+    parser.add_argument(
+        '-lo', '--layout',
+        default='table',
+        choices=LAYOUTS,
+        help='"table" creates a table for the estimates and another for '
+             'the margins of error of each ACS table (over 20,000 tables), '
+             '"sequence" creates a single table per sequence file that '
+             'holds both side by side, with views named like the tables of '
+             'the "table" layout so existing queries keep working'
+    )
+    parser.add_argument(
+        '-ct', '--cell_type',
+        default='numeric',
+        choices=CELL_TYPES,
+        help='"numeric" stores every cell as an arbitrary precision '
+             'numeric, "compact" reads a sample of each sequence file and '
+             'gives each column the smallest of integer, bigint, real or '
+             'double precision that holds its values, "array" also does '
+             'this but packs the cells of each table into a single array '
+             'column named "cells" (or "b01001_e", etc. with the '
+             '"sequence" layout, whose views still have a column per cell)'
+    )
+    parser.add_argument(
+        '-pt', '--partition',
+        action='store_true',
+        help='create geoheader and the acs tables as tables partitioned by '
+             'state (requires postgres 12+), each state is loaded into a '
+             'staging table that is swapped in as its partition once it is '
+             'complete, if the schema is already partitioned it is kept and '
+             'only the supplied states are reloaded, partitioned tables '
+             "can't have the foreign keys to geoheader and its tiger_geoid "
+             "index isn't unique, so tiger tables can't reference it"
+    )
+    parser.add_argument(
+        '-r', '--resume',
+        action='store_true',
+        help='keep the existing schema and continue a load that was '
+             'interrupted, states and sequences that were committed by '
+             'the previous run are skipped'
+    )
+    parser = utils.add_loader_options(parser)
+    parser = utils.add_metrics_options(parser)
     parser = utils.add_postgres_options(parser)
 
+    # caches for the zip archives that ACS files are streamed from, the
+    # refresh flag is set by main when a partitioned schema is reused
+    parser.set_defaults(archive_index=dict(), archives=dict(), refresh=False)
     options = parser.parse_args(arg_list)
     return options
 
@@ -408,12 +1678,13 @@ def make_table_mapping():
     reduces the number of files that have to generated for the sqlalchemy
     model and thus speeds that creation process"""
 
-    if not gv.metadata.tables:
-        gv.metadata.reflect(schema=gv.metadata.schema)
-
+    # only the table and view names are needed so the schema isn't
+    # reflected, views are created by the 'sequence' layout
+    inspector = sqlalchemy.inspect(gv.engine)
+    schema = gv.metadata.schema
     tbl_mapping = dict()
-    for schema_table in gv.metadata.tables:
-        table = schema_table.split('.')[1]
+    for table in inspector.get_table_names(schema) + \
+            inspector.get_view_names(schema):
         model = table[:6]
         tbl_mapping[table] = model
 
@@ -427,6 +1698,7 @@ def main():
     global gv
     args = sys.argv[1:]
     gv = process_options(args)
+    metrics.configure(gv.metrics, gv.profile)
 
     pg_url = PG_URL.format(user=gv.user, pw=gv.password,
                            host=gv.host, db=gv.dbname)
@@ -437,13 +1709,53 @@ def main():
         bind=gv.engine,
         schema=ACS_SCHEMA.format(yr=gv.acs_year, span=gv.span))
 
+    if gv.loader == 'parquet' and (gv.resume or gv.partition or gv.add_states):
+        raise ValueError(
+            'the "resume", "partition" and "add_states" flags only apply to '
+            'the database, the parquet loader replaces the files of the '
+            'supplied states and leaves those of other states in place')
+
+    # when adding states only those that aren't in the schema yet are
+    # downloaded and loaded
+    if gv.add_states:
+        gv.states = get_new_states()
+        if not gv.states:
+            print 'all of the supplied states are already loaded'
+            return
+
     download_acs_data()
-    drop_create_acs_schema(True)
+
+    # the parquet loader writes the same tables to files partitioned by
+    # state and skips the steps that only apply to the database
+    if gv.loader == 'parquet':
+        write_parquet_tables()
+        metrics.print_summary()
+        return
+
+    # when partitioning into a schema whose tables are already
+    # partitioned the schema is kept and only the supplied states are
+    # swapped in, in that case or when adding states to an existing
+    # schema the ledger entries of the last run are cleared
+    gv.refresh = gv.partition and not gv.resume and is_partitioned_schema()
+    drop_create_acs_schema(not (gv.resume or gv.refresh or gv.add_states))
+    gv.completed = utils.get_completed(gv.engine, gv.metadata.schema)
+    if gv.refresh or (gv.add_states and not gv.resume):
+        clear_state_ledger()
     create_geoheader()
     create_acs_tables()
 
+    if gv.defer_constraints:
+        add_deferred_constraints()
+
+    if gv.optimize:
+        optimize_acs_tables()
+
     if gv.model:
-        utils.generate_model(gv.metadata, make_table_mapping(), [GEOHEADER])
+        utils.generate_model(
+            gv.metadata, make_table_mapping(), [GEOHEADER, LEDGER],
+            gv.workers)
+
+    metrics.print_summary()
 
 
 if __name__ == '__main__':
@@ -1,26 +1,57 @@
 # Utilities that are used by multiple scripts in the censuspgsql package
 
+import codecs
+import cPickle
 import csv
+import hashlib
+import json
 import os
-import subprocess
 import sys
+import time
 import urllib2
 from collections import defaultdict
+from cStringIO import StringIO
+from email.utils import mktime_tz, parsedate_tz
+from itertools import imap, islice
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from operator import attrgetter
 from pkg_resources import resource_filename
-from os.path import abspath, basename, exists, join
+from os.path import abspath, basename, dirname, exists, getmtime, \
+    getsize, join
 
+import sqlacodegen
+import sqlalchemy
 from appdirs import user_cache_dir
+from sqlacodegen.codegen import CodeGenerator
+from sqlalchemy import text, MetaData, Table
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.schema import CreateIndex, CreateTable
+
+import censuspgsql.metrics as metrics
+import censuspgsql.parquet as parquet
 
 ACS_MOD = 'ACS'
 ACS_SCHEMA = 'acs{yr}_{span}yr'
 ACS_SPANS = (1, 3, 5)
+COPY_BUFFER = 2**16
+DOWNLOAD_BLOCK = 2**20
+DOWNLOAD_WORKERS = 4
 GEOHEADER = 'geoheader'
 GEOID = 'geoid'
+INSERT_BATCH = 10000
+LEDGER = 'load_ledger'
+LOADERS = ('copy', 'insert', 'parquet')
+METADATA_CACHE = 'metadata'
 MODEL = 'model'
+MODEL_MANIFEST = 'manifest.json'
 PG_URL = 'postgres://{user}:{pw}@{host}/{db}'
 TIGER_GEOID = 'tiger_{}'.format(GEOID)
 TIGER_MOD = 'TIGER'
 
+# table groups to be written by generate_model, see write_model_module
+_model_jobs = list()
+
 
 def get_states_mapping(module):
     """Maps state abbreviations to their full name or FIPS code"""
@@ -46,63 +77,525 @@ def get_states_mapping(module):
     return states, key_word
 
 
-def download_with_progress(url, dir):
+class HeadRequest(urllib2.Request):
+    """"""
+
+    def get_method(self):
+        return 'HEAD'
+
+
+def get_remote_info(url):
+    """Returns the size in bytes and the last modified time (in seconds
+    since the epoch) of the file at the supplied url, either is None if
+    the server doesn't report it"""
+
+    # only the headers are needed, http servers will honor a HEAD
+    # request, but other protocols (ftp) must be opened normally
+    if url.startswith('http'):
+        request = HeadRequest(url)
+    else:
+        request = urllib2.Request(url)
+
+    u = urllib2.urlopen(request)
+    try:
+        content_length = u.info().getheaders('Content-Length')
+        last_modified = u.info().getheaders('Last-Modified')
+    finally:
+        u.close()
+
+    remote_size = int(content_length[0]) if content_length else None
+    remote_time = None
+    if last_modified:
+        time_tuple = parsedate_tz(last_modified[0])
+        remote_time = mktime_tz(time_tuple) if time_tuple else None
+
+    return remote_size, remote_time
+
+
+def get_md5(file_path):
     """"""
 
+    md5 = hashlib.md5()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(DOWNLOAD_BLOCK), ''):
+            md5.update(block)
+
+    return md5.hexdigest()
+
+
+def download_with_progress(url, dir, md5=None, show_progress=True):
+    """Download the file at url to the supplied directory, files that
+    were already fully downloaded and match the size reported by the
+    server (or the supplied md5 checksum) are skipped and partially
+    downloaded files are resumed with a Range request when possible"""
+
     # function adapted from: http://stackoverflow.com/questions/22676
 
     file_name = basename(url)
     file_path = join(dir, file_name)
-    u = urllib2.urlopen(url)
-    f = open(file_path, 'wb')
-    meta = u.info()
-    file_size = int(meta.getheaders('Content-Length')[0])
-    print '\ndownload directory: {}'.format(dir)
-    print 'download file name: {} '.format(file_name)
-    print 'download size: {:,} bytes'.format(file_size)
-
-    file_size_dl = 0
-    block_sz = 8192
+    part_path = '{}.part'.format(file_path)
+
+    # files are written to a '.part' path and only moved to their final
+    # name once complete, so anything at the final path is a finished
+    # download and only needs to be checked against the remote version
+    remote_size, remote_time = get_remote_info(url)
+    if exists(file_path):
+        if md5:
+            is_current = get_md5(file_path) == md5
+        elif remote_size is not None:
+            is_current = getsize(file_path) == remote_size
+        else:
+            is_current = True
+
+        if is_current:
+            if show_progress:
+                print '\nusing cached file: {}'.format(file_path)
+            return file_path
+
+        os.remove(file_path)
+
+    # a '.part' file that is larger than the remote file, or that was
+    # last written to before the remote file changed, holds the start of
+    # an older version and can't be resumed
+    start_size = 0
+    if exists(part_path):
+        part_size = getsize(part_path)
+        if (remote_size is not None and part_size > remote_size) or \
+                (remote_time and remote_time > getmtime(part_path)):
+            if show_progress:
+                print '\ndiscarding stale partial download: {}'.format(
+                    part_path)
+            os.remove(part_path)
+        elif url.startswith('http'):
+            start_size = part_size
+
+    # a '.part' file that already holds the entire remote file was
+    # interrupted before it was renamed and only needs to be verified
+    start_time = time.time()
+    file_size = remote_size
+    if not start_size or start_size != remote_size:
+        file_size = write_part_file(
+            url, part_path, start_size, remote_size, show_progress)
+
+    # an incomplete download is kept so that the next attempt resumes it,
+    # one that doesn't match its checksum is corrupt and is removed
+    file_size_dl = getsize(part_path)
+    if file_size is not None and file_size_dl != file_size:
+        raise IOError(
+            'download of {0} is incomplete, {1:,} of {2:,} bytes were '
+            'received and kept in: {3}'.format(
+                url, file_size_dl, file_size, part_path))
+
+    if md5 and get_md5(part_path) != md5:
+        os.remove(part_path)
+        raise IOError('checksum of download from {} does not match the '
+                      'expected value: {}'.format(url, md5))
+
+    os.rename(part_path, file_path)
+    metrics.record('download', time.time() - start_time,
+                   bytes_=file_size_dl - start_size, file=file_name)
+    if show_progress:
+        print '\ndownloaded: {0} ({1:,} bytes)'.format(
+            file_path, file_size_dl)
+
+    return file_path
+
+
+def write_part_file(url, part_path, start_size, remote_size,
+                    show_progress=True):
+    """Write the file at url to part_path, resuming from start_size bytes
+    if that's greater than zero and the server supports it, returns the
+    expected size of the complete file or None if it isn't known"""
+
+    request = urllib2.Request(url)
+    if start_size:
+        request.add_header('Range', 'bytes={}-'.format(start_size))
+
+    u = urllib2.urlopen(request)
+
+    # a status other than 206 (partial content) means the server
+    # ignored the range header and is sending the entire file
+    file_size_dl = start_size
+    if file_size_dl and u.getcode() != 206:
+        file_size_dl = 0
+
+    mode = 'ab' if file_size_dl else 'wb'
+    file_size = remote_size
+    if file_size is None:
+        content_length = u.info().getheaders('Content-Length')
+        file_size = file_size_dl + int(content_length[0]) \
+            if content_length else None
+
+    if show_progress:
+        print '\ndownload directory: {}'.format(dirname(part_path))
+        print 'download file name: {} '.format(basename(url))
+        print 'download size: {:,} bytes'.format(file_size or 0)
+        if file_size_dl:
+            print 'resuming from: {:,} bytes'.format(file_size_dl)
+
+    with open(part_path, mode) as f:
+        while True:
+            buffer_ = u.read(DOWNLOAD_BLOCK)
+            if not buffer_:
+                break
+
+            file_size_dl += len(buffer_)
+            f.write(buffer_)
+
+            if show_progress and file_size:
+                status = '{0:12,d}  [{1:3.2f}%]'.format(
+                    file_size_dl, file_size_dl * 100. / file_size)
+                status += chr(8) * (len(status) + 1)
+                print status,
+
+    u.close()
+
+    return file_size
+
+
+def download_files(downloads, workers=DOWNLOAD_WORKERS):
+    """Fetch each of the supplied (url, directory) pairs, a checksum can
+    be included as a third item in any of the pairs, files are downloaded
+    concurrently by a pool of 'workers' threads, the local paths of the
+    files are returned in the same order as downloads"""
+
+    if workers <= 1 or len(downloads) <= 1:
+        return [download_with_progress(*d) for d in downloads]
+
+    # progress bars from concurrent downloads would overwrite each other
+    # so each download is quiet and only the total is reported
+    def download(args):
+        url, dir_ = args[:2]
+        md5 = args[2] if len(args) > 2 else None
+        return download_with_progress(url, dir_, md5, show_progress=False)
+
+    print '\ndownloading {0} files with {1} threads...'.format(
+        len(downloads), workers)
+
+    pool = ThreadPool(min(workers, len(downloads)))
+    try:
+        file_paths = pool.map(download, downloads)
+    finally:
+        pool.close()
+        pool.join()
+
+    print 'downloaded {} files'.format(len(file_paths))
+    return file_paths
+
+
+class CopyStream(object):
+    """File-like wrapper that serializes an iterable of rows to csv on
+    demand, this allows rows to be fed to postgres' COPY ... FROM STDIN
+    via psycopg2's copy_expert without building the entire payload in
+    memory first"""
+
+    def __init__(self, rows, chunk_rows=1000):
+        self.row_count = 0
+        self.byte_count = 0
+        self._rows = iter(rows)
+        self._chunk_rows = chunk_rows
+        self._pending = ''
+        self._buffer = StringIO()
+        self._writer = csv.writer(self._buffer, lineterminator='\n')
+
+    def read(self, size=-1):
+        while size < 0 or len(self._pending) < size:
+            chunk = self._next_chunk()
+            if not chunk:
+                break
+            self._pending += chunk
+
+        if size < 0:
+            data, self._pending = self._pending, ''
+        else:
+            data = self._pending[:size]
+            self._pending = self._pending[size:]
+
+        return data
+
+    def _next_chunk(self):
+        # None values are written as unquoted empty strings which COPY
+        # interprets as NULL when using the csv format
+        count = 0
+        for row in islice(self._rows, self._chunk_rows):
+            self._writer.writerow(row)
+            count += 1
+
+        self.row_count += count
+        chunk = self._buffer.getvalue()
+        self.byte_count += len(chunk)
+        self._buffer.seek(0)
+        self._buffer.truncate()
+
+        return chunk
+
+
+def copy_rows(engine, table, rows):
+    """Stream rows into the supplied table using COPY ... FROM STDIN,
+    each row must be a sequence whose values are ordered in the same
+    way as the table's columns, returns the number of rows written"""
+
+    columns = ', '.join([c.name for c in table.columns])
+    copy_sql = 'COPY {table} ({columns}) FROM STDIN WITH CSV'.format(
+        table=table.fullname, columns=columns)
+    stream = CopyStream(rows)
+    start_time = time.time()
+
+    # copy_expert isn't exposed through sqlalchemy so the underlying
+    # psycopg2 connection is used here
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.copy_expert(copy_sql, stream, size=COPY_BUFFER)
+        connection.commit()
+    finally:
+        connection.close()
+
+    metrics.record('insert', time.time() - start_time, stream.row_count,
+                   stream.byte_count, table=table.fullname)
+
+    return stream.row_count
+
+
+def insert_rows(engine, table, rows, batch_size=INSERT_BATCH):
+    """Fallback for copy_rows that writes rows as batches of
+    parameterized inserts, returns the number of rows written"""
+
+    # this type bulk of insert uses sqlalchemy core and is faster than
+    # other insert methods, see details here:
+    # http://docs.sqlalchemy.org/en/rel_0_8/faq.html#
+    # i-m-inserting-400-000-rows-with-the-orm-and-it-s-really-slow
+    names = [c.name for c in table.columns]
+    row_count = 0
+    start_time = time.time()
+    for batch in iter_chunks(rows, batch_size):
+        records = [dict(zip(names, r)) for r in batch]
+        engine.execute(table.insert(), records)
+        row_count += len(records)
+
+    # parameters aren't serialized by this code so no byte count is
+    # available for this loader
+    metrics.record('insert', time.time() - start_time, row_count,
+                   table=table.fullname)
+
+    return row_count
+
+
+def iter_chunks(iterable, size):
+    """Generator that yields lists of at most 'size' items from the
+    supplied iterable, this allows rows to be consumed from a generator
+    in fixed size pieces"""
+
+    iterator = iter(iterable)
     while True:
-        buffer_ = u.read(block_sz)
-        if not buffer_:
+        chunk = list(islice(iterator, size))
+        if not chunk:
             break
 
-        file_size_dl += len(buffer_)
-        f.write(buffer_)
+        yield chunk
 
-        status = '{0:12,d}  [{1:3.2f}%]'.format(
-            file_size_dl, file_size_dl * 100. / file_size)
-        status += chr(8) * (len(status) + 1)
-        print status,
 
-    f.close()
+def load_rows(engine, table, rows, loader='copy', batch_size=INSERT_BATCH):
+    """Write rows to table with the method indicated by loader, which
+    must be one of the values in LOADERS, rows may be a generator in
+    which case they're consumed lazily by any of the loaders"""
+
+    if loader == 'copy':
+        return copy_rows(engine, table, rows)
+    elif loader == 'insert':
+        return insert_rows(engine, table, rows, batch_size)
+    elif loader == 'parquet':
+        return parquet.write_rows(table, rows, batch_size)
+    else:
+        raise ValueError('loader must be one of: {}'.format(LOADERS))
 
-    return file_path
 
+def create_ledger(engine, schema):
+    """Create the control table that records which units of work have
+    been committed to the supplied schema, this allows an interrupted
+    load to be resumed"""
 
-def generate_model(metadata, tbl_mapping=None, tbl_exclude=list()):
+    engine.execute(
+        "CREATE TABLE IF NOT EXISTS {schema}.{ledger} ("
+        "item text PRIMARY KEY, "
+        "completed timestamp NOT NULL DEFAULT now());".format(
+            schema=schema, ledger=LEDGER))
+
+
+def get_completed(engine, schema):
+    """Returns the set of items that have been recorded in the ledger
+    of the supplied schema"""
+
+    items = engine.execute(
+        "SELECT item FROM {schema}.{ledger};".format(
+            schema=schema, ledger=LEDGER))
+
+    return {i[0] for i in items}
+
+
+def mark_completed(engine, schema, item):
+    """Record in the ledger that the supplied item has been committed,
+    items that are already recorded are left as they are"""
+
+    engine.execute(
+        text("INSERT INTO {schema}.{ledger} (item) VALUES (:item) "
+             "ON CONFLICT DO NOTHING;".format(schema=schema, ledger=LEDGER)),
+        item=item)
+
+
+def clear_completed(engine, schema, items):
+    """Remove the supplied items from the ledger so that they're loaded
+    again"""
+
+    if items:
+        engine.execute(
+            text("DELETE FROM {schema}.{ledger} "
+                 "WHERE item IN :items;".format(schema=schema, ledger=LEDGER)),
+            items=tuple(items))
+
+
+def run_timed(engine, label, statements):
+    """Execute the supplied sql statements in a single transaction and
+    report how long they took, returns the elapsed seconds"""
+
+    start_time = time.time()
+    with engine.begin() as connection:
+        for sql in statements:
+            connection.execute(sql)
+
+    seconds = time.time() - start_time
+    metrics.record('optimize', seconds, step=label)
+    print '{0}: {1:,.1f} seconds'.format(label, seconds)
+
+    return seconds
+
+
+def print_throughput(row_count, seconds, unit='rows'):
     """"""
 
-    url = metadata.bind.url
+    rate = row_count / seconds if seconds else 0
+    print '\n{0:,} {unit} loaded in {1:,.1f} seconds ' \
+          '({2:,.0f} {unit}/sec)'.format(row_count, seconds, rate, unit=unit)
+
+
+def get_schema_signature(engine, schema):
+    """Returns an md5 hash of the catalog entries that define the tables
+    and views of the supplied schema (columns, types, constraints,
+    indices and comments), it changes whenever the reflected schema
+    would, but is computed by the database in a single query"""
+
+    signature = engine.execute(text(
+        "SELECT md5(coalesce(string_agg(def, ';' ORDER BY def), '')) "
+        "FROM ("
+        "SELECT c.relname || '.' || a.attname || ':' "
+        "|| format_type(a.atttypid, a.atttypmod) || ':' || a.attnotnull "
+        "|| ':' || coalesce(col_description(c.oid, a.attnum), '') AS def "
+        "FROM pg_class c "
+        "JOIN pg_namespace n ON n.oid = c.relnamespace "
+        "JOIN pg_attribute a ON a.attrelid = c.oid "
+        "WHERE n.nspname = :schema AND c.relkind IN ('r', 'v', 'm', 'p') "
+        "AND a.attnum > 0 AND NOT a.attisdropped "
+        "UNION ALL "
+        "SELECT c.relname || ':' || c.relkind::text || ':' "
+        "|| coalesce(obj_description(c.oid, 'pg_class'), '') || ':' "
+        "|| CASE WHEN c.relkind IN ('v', 'm') "
+        "THEN pg_get_viewdef(c.oid) ELSE '' END "
+        "FROM pg_class c "
+        "JOIN pg_namespace n ON n.oid = c.relnamespace "
+        "WHERE n.nspname = :schema AND c.relkind IN ('r', 'v', 'm', 'p') "
+        "UNION ALL "
+        "SELECT conrelid::regclass::text || ':' || conname || ':' "
+        "|| pg_get_constraintdef(c.oid) "
+        "FROM pg_constraint c "
+        "JOIN pg_namespace n ON n.oid = c.connamespace "
+        "WHERE n.nspname = :schema "
+        "UNION ALL "
+        "SELECT indexdef FROM pg_indexes WHERE schemaname = :schema"
+        ") defs;"), schema=schema).scalar()
+
+    return signature
+
+
+def reflect_schema(engine, schema):
+    """Returns a MetaData object holding every table and view in the
+    supplied schema, the reflected metadata is pickled to the cache
+    directory and reused for as long as the schema's catalog signature
+    (and the sqlalchemy version) is unchanged"""
+
+    cache_dir = join(user_cache_dir(__package__), METADATA_CACHE)
+    cache_path = join(cache_dir, '{}.pickle'.format(schema))
+    cache_key = '{0}:{1}'.format(
+        sqlalchemy.__version__, get_schema_signature(engine, schema))
+
+    if exists(cache_path):
+        try:
+            with open(cache_path, 'rb') as cache_file:
+                key, metadata = cPickle.load(cache_file)
+        except (cPickle.UnpicklingError, EOFError, ValueError):
+            key = None
+
+        if key == cache_key:
+            print '\nusing cached metadata for schema {}'.format(schema)
+            metadata.bind = engine
+            return metadata
+
+    print '\nreflecting schema {}...'.format(schema)
+    metadata = MetaData(bind=engine)
+    metadata.reflect(schema=schema, views=True)
+
+    if not exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    # the file is written under a temporary name and moved into place so
+    # that an interrupted write never leaves a truncated cache behind
+    temp_path = '{}.tmp'.format(cache_path)
+    with open(temp_path, 'wb') as cache_file:
+        cPickle.dump(
+            (cache_key, metadata), cache_file, cPickle.HIGHEST_PROTOCOL)
+    os.rename(temp_path, cache_path)
+
+    return metadata
+
+
+def get_table(metadata, name, schema=None):
+    """Returns the named table from the supplied metadata object, it is
+    only reflected from the database the first time it is accessed,
+    None is returned if the table doesn't exist"""
+
+    schema = schema or metadata.schema
+    key = '{0}.{1}'.format(schema, name) if schema else name
+    if key in metadata.tables:
+        return metadata.tables[key]
+
+    try:
+        return Table(name, metadata, schema=schema, autoload=True)
+    except sqlalchemy.exc.NoSuchTableError:
+        return None
+
+
+def generate_model(metadata, tbl_mapping=None, tbl_exclude=list(),
+                   workers=1):
+    """Write a sqlalchemy model module for each group of tables in the
+    schema of the supplied metadata object, the schema is reflected once
+    and sqlacodegen is run in-process, modules whose table definitions
+    haven't changed since the previous run are skipped"""
+
     schema = metadata.schema
     model_dir = join(abspath(__package__), MODEL)
 
-    # if the table models aren't in memory reflect them for the
-    # assigned schema
-    if not metadata.tables:
-        metadata.reflect(schema=schema)
+    # the model is always generated from the tables as they exist in the
+    # database rather than those defined in memory, since constraints
+    # may have been added after the tables were created
+    model_meta = reflect_schema(metadata.bind, schema)
 
     tbl_groups = defaultdict(list)
-    for tbl_path in metadata.tables:
-        tbl_schema, table = tbl_path.split('.')
-
+    for table in model_meta.tables.values():
         # only model tables in the schema assigned to the metadata object
-        if tbl_schema == schema and table not in tbl_exclude:
+        if table.schema == schema and table.name not in tbl_exclude:
             if tbl_mapping:
-                tbl_key = tbl_mapping[table]
+                tbl_key = tbl_mapping[table.name]
             else:
-                tbl_key = table
+                tbl_key = table.name
             tbl_groups[tbl_key].append(table)
 
     if not exists(model_dir):
@@ -114,28 +607,128 @@ def generate_model(metadata, tbl_mapping=None, tbl_exclude=list()):
         os.makedirs(schema_dir)
         open(join(schema_dir, '__init__.py'), 'w').close()
 
-    codegen_template = './bin/sqlacodegen --nojoined ' \
-                       '--schema {0} --tables {1} ' \
-                       '--outfile {2} {url}'
+    # the manifest maps each module to a hash of the definitions of the
+    # tables it was generated from
+    manifest_path = join(schema_dir, MODEL_MANIFEST)
+    manifest = dict()
+    if exists(manifest_path):
+        with open(manifest_path) as manifest_file:
+            manifest = json.load(manifest_file)
 
-    print '\ngenerating sqlalchemy model at: {}'.format(schema_dir)
-    print 'table groups written:'
-
-    i = 0
-    for tbl_key, tbl_list in tbl_groups.items():
-        tbl_str = ','.join(sorted(tbl_list))
+    # modules of table groups that no longer exist are removed
+    for tbl_key in set(manifest) - set(tbl_groups):
+        model_file = join(schema_dir, '{}.py'.format(tbl_key))
+        if exists(model_file):
+            os.remove(model_file)
+        del manifest[tbl_key]
+
+    # the jobs are stored at the module level so that forked worker
+    # processes inherit the reflected tables and only need to be passed
+    # an index
+    del _model_jobs[:]
+    for tbl_key, tables in sorted(tbl_groups.items()):
         model_file = join(schema_dir, '{}.py'.format(tbl_key))
-        codegen = codegen_template.format(
-            schema, tbl_str, model_file, url=url)
+        model_tables = get_model_tables(tables)
+        tbl_hash = get_table_hash(model_tables)
+        if manifest.get(tbl_key) != tbl_hash or not exists(model_file):
+            _model_jobs.append((model_tables, model_file))
+            manifest[tbl_key] = tbl_hash
 
-        subprocess.call(codegen)
+    print 'generating sqlalchemy model at: {}'.format(schema_dir)
+    print '{0} of {1} modules are unchanged, table groups written:'.format(
+        len(tbl_groups) - len(_model_jobs), len(tbl_groups))
 
+    with metrics.phase('model', schema=schema) as tracker:
         # logging for user
-        i += 1
-        if i % 50 == 0:
-            sys.stdout.write(str(i))
-        else:
-            sys.stdout.write('.')
+        # rendering is cpu bound so processes are used rather than
+        # threads, the workers don't need a database connection
+        model_jobs = map_jobs(
+            write_model_module, xrange(len(_model_jobs)), workers)
+        for i, tbl_count in enumerate(model_jobs, 1):
+            tracker.rows += tbl_count
+            if i % 50 == 0:
+                sys.stdout.write(str(i))
+            else:
+                sys.stdout.write('.')
+
+    # the manifest is only written once all modules have been generated
+    # so that an interrupted run regenerates anything it didn't finish
+    with open(manifest_path, 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+
+
+def map_jobs(function, items, workers, initializer=None):
+    """Generator that calls function with each of the supplied items,
+    either serially or spread across a pool of 'workers' processes that
+    are set up by initializer, and yields each result as it completes,
+    the results of a pool aren't in the order of items"""
+
+    if workers <= 1 or len(items) <= 1:
+        for result in imap(function, items):
+            yield result
+        return
+
+    pool = Pool(min(workers, len(items)), initializer=initializer)
+    try:
+        # the metrics that each job recorded are returned with its
+        # result so that they're included in this process's summary
+        jobs = ((function, item) for item in items)
+        for result, totals in pool.imap_unordered(metrics.run_job, jobs):
+            metrics.add_totals(totals)
+            yield result
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+def get_model_tables(tables):
+    """Returns the supplied tables along with any tables that their
+    foreign keys refer to, this mirrors the sqlacodegen console script
+    which reflects referenced tables along with those requested"""
+
+    model_tables = dict()
+    pending = list(tables)
+    while pending:
+        table = pending.pop()
+        if table.key not in model_tables:
+            model_tables[table.key] = table
+            pending.extend([fk.column.table for fk in table.foreign_keys])
+
+    return model_tables.values()
+
+
+def write_model_module(job_ix):
+    """Render the model module of a single table group, returns the
+    number of tables in the module"""
+
+    model_tables, model_file = _model_jobs[job_ix]
+    group_meta = MetaData()
+    for table in model_tables:
+        table.tometadata(group_meta)
+
+    generator = CodeGenerator(group_meta, nojoined=True)
+    with codecs.open(model_file, 'w', encoding='utf-8') as outfile:
+        generator.render(outfile)
+
+    return len(model_tables)
+
+
+def get_table_hash(tables):
+    """Returns an md5 hash of the DDL of the supplied tables and their
+    indices, along with the version of sqlacodegen, this changes
+    whenever the module generated from the tables would"""
+
+    dialect = postgresql.dialect()
+    md5 = hashlib.md5(sqlacodegen.version)
+    for table in sorted(tables, key=attrgetter('name')):
+        md5.update(str(CreateTable(table).compile(dialect=dialect)))
+        for index in sorted(table.indexes, key=attrgetter('name')):
+            md5.update(str(CreateIndex(index).compile(dialect=dialect)))
+
+    return md5.hexdigest()
 
 
 def add_postgres_options(parser):
@@ -174,6 +767,72 @@ def add_postgres_options(parser):
     return parser
 
 
+def add_loader_options(parser):
+    """"""
+
+    parser.add_argument(
+        '-ld', '--loader',
+        default='copy',
+        choices=LOADERS,
+        help='method used to write rows to the database, "copy" streams '
+             'them with COPY ... FROM STDIN, "insert" uses the slower '
+             'parameterized inserts and is retained as a fallback, '
+             '"parquet" writes the tables to parquet files partitioned by '
+             'state in "output_dir" instead of to the database (requires '
+             'pyarrow)'
+    )
+    parser.add_argument(
+        '-od', '--output_dir',
+        default='parquet',
+        help='directory that the "parquet" loader writes to, each schema '
+             'and table is a folder within it, the partitions of the '
+             'states being loaded are replaced'
+    )
+    parser.add_argument(
+        '-cs', '--chunk_size',
+        default=INSERT_BATCH,
+        type=int,
+        help='maximum number of rows buffered per table before they are '
+             'written to the database, peak memory use is bounded by this '
+             'value rather than the number of states being loaded, it is '
+             'also the batch size of the "insert" loader and the row group '
+             'size of the "parquet" loader'
+    )
+    parser.add_argument(
+        '-o', '--optimize',
+        action='store_true',
+        help='once data is loaded build indices that were deferred and '
+             'refresh the planner statistics of the new tables with ANALYZE'
+    )
+    parser.add_argument(
+        '-w', '--workers',
+        default=1,
+        type=int,
+        help='number of processes used to load data concurrently, each '
+             'process opens its own database connection'
+    )
+
+    return parser
+
+
+def add_metrics_options(parser):
+    """"""
+
+    parser.add_argument(
+        '-m', '--metrics',
+        help='path of a file that the timing and throughput of each phase '
+             '(download, unzip, parse, insert, comments, model, etc.) is '
+             'appended to as json lines, one per table or file processed'
+    )
+    parser.add_argument(
+        '-pr', '--profile',
+        help='directory that cProfile output is written to, one .prof file '
+             'is created for each top level phase of each process'
+    )
+
+    return parser
+
+
 def add_census_options(parser, module):
     """"""
 
@@ -203,6 +862,21 @@ def add_census_options(parser, module):
              'created, use this flag to opt out of that functionality'
     )
 
+    parser.add_argument(
+        '-as', '--add_states',
+        action='store_true',
+        help='keep the existing schema and only download and load the '
+             'supplied states that are not already in it, this extends '
+             'a previous load without reloading the states it covered'
+    )
+    parser.add_argument(
+        '-dw', '--download_workers',
+        default=DOWNLOAD_WORKERS,
+        type=int,
+        help='maximum number of files that are downloaded concurrently, '
+             'files that are already in the cache are not fetched again'
+    )
+
     # data_dir is not user configurable, it is convenient to store it
     # similar settings that are in the global argparse namespace object
     data_dir = join(user_cache_dir(__package__), module)
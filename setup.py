@@ -14,17 +14,23 @@ setup(
         'console_scripts': [
             'postgres_acs = censuspgsql.postgres_acs:main',
             'postgis_tiger = censuspgsql.postgis_tiger:main',
+            'census_benchmark = censuspgsql.benchmark:main',
             'sqlacodegen = sqlacodegen.main:main'
         ]
     },
+    extras_require={
+        'benchmark': ['xlwt>=1.0.0'],
+        'parquet': ['pyarrow>=0.15.0']
+    },
     include_package_data=True,
     install_requires=[
         'appdirs>=1.4.0',
         'fiona>=1.5.1',
         'gdal>=1.11.2',
         'geoalchemy2>=0.2.6',
+        'numpy>=1.10.0',
         'psycopg2>=2.6.1',
-        'pyproj>=1.9.5.1',
+        'pyproj>=2.1.0',
         'shapely>=1.5.13',
         'sqlacodegen>=1.1.6',
         'sqlalchemy>=1.0.11',
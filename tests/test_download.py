@@ -0,0 +1,153 @@
+"""Tests of utilities.download_with_progress against a local http server
+that stands in for the census ftp site, run with:
+python -m unittest discover tests"""
+
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from os.path import exists, join
+
+from censuspgsql import utilities as utils
+
+CONTENT = ''.join(chr(i % 256) for i in xrange(100000))
+FILE_NAME = 'seq.zip'
+
+
+class CensusHandler(BaseHTTPRequestHandler):
+    """Serves CONTENT, honoring Range headers unless the server's
+    ignore_range flag is set and leaving off the number of bytes set by
+    its truncate attribute, the requests received are recorded on the
+    server so that tests can check which were made"""
+
+    def do_HEAD(self):
+        self.server.requests.append(('HEAD', None))
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(CONTENT)))
+        self.send_header('Last-Modified', self.date_time_string(
+            self.server.modified))
+        self.end_headers()
+
+    def do_GET(self):
+        range_ = self.headers.getheader('Range')
+        self.server.requests.append(('GET', range_))
+
+        start = 0
+        match = re.match(r'bytes=(\d+)-$', range_ or '')
+        if match and not self.server.ignore_range:
+            start = int(match.group(1))
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {0}-{1}/{2}'.format(
+                start, len(CONTENT) - 1, len(CONTENT)))
+        else:
+            self.send_response(200)
+
+        # a truncated response mimics a connection that drops part way
+        # through the download
+        self.send_header('Content-Length', str(len(CONTENT) - start))
+        self.end_headers()
+        self.wfile.write(CONTENT[start:len(CONTENT) - self.server.truncate])
+
+    def log_message(self, *args):
+        pass
+
+
+class DownloadTest(unittest.TestCase):
+    """"""
+
+    def setUp(self):
+        self.server = HTTPServer(('localhost', 0), CensusHandler)
+        self.server.requests = list()
+        self.server.ignore_range = False
+        self.server.truncate = 0
+        self.server.modified = time.time() - 3600
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+        self.url = 'http://localhost:{0}/{1}'.format(
+            self.server.server_port, FILE_NAME)
+        self.dir = tempfile.mkdtemp()
+        self.file_path = join(self.dir, FILE_NAME)
+        self.part_path = self.file_path + '.part'
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.dir)
+
+    def download(self):
+        return utils.download_with_progress(
+            self.url, self.dir, show_progress=False)
+
+    def write(self, path, data):
+        with open(path, 'wb') as f:
+            f.write(data)
+
+    def read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def get_requests(self):
+        return [r for r in self.server.requests if r[0] == 'GET']
+
+    def test_download(self):
+        self.assertEqual(self.download(), self.file_path)
+        self.assertEqual(self.read(self.file_path), CONTENT)
+        self.assertFalse(exists(self.part_path))
+
+    def test_skip_complete_file(self):
+        self.write(self.file_path, CONTENT)
+        self.download()
+        self.assertEqual(self.get_requests(), [])
+
+    def test_replace_outdated_file(self):
+        self.write(self.file_path, CONTENT[:10])
+        self.download()
+        self.assertEqual(self.read(self.file_path), CONTENT)
+
+    def test_resume_with_range(self):
+        self.write(self.part_path, CONTENT[:40000])
+        self.download()
+        self.assertEqual(self.get_requests(), [('GET', 'bytes=40000-')])
+        self.assertEqual(self.read(self.file_path), CONTENT)
+
+    def test_server_ignores_range(self):
+        self.server.ignore_range = True
+        self.write(self.part_path, CONTENT[:40000])
+        self.download()
+        self.assertEqual(self.get_requests(), [('GET', 'bytes=40000-')])
+        self.assertEqual(self.read(self.file_path), CONTENT)
+
+    def test_complete_part_file(self):
+        self.write(self.part_path, CONTENT)
+        self.download()
+        self.assertEqual(self.get_requests(), [])
+        self.assertEqual(self.read(self.file_path), CONTENT)
+
+    def test_discard_larger_part_file(self):
+        self.write(self.part_path, CONTENT + 'stale')
+        self.download()
+        self.assertEqual(self.get_requests(), [('GET', None)])
+        self.assertEqual(self.read(self.file_path), CONTENT)
+
+    def test_discard_part_file_older_than_remote(self):
+        self.write(self.part_path, 'x' * 40000)
+        os.utime(self.part_path, (time.time() - 7200,) * 2)
+        self.download()
+        self.assertEqual(self.get_requests(), [('GET', None)])
+        self.assertEqual(self.read(self.file_path), CONTENT)
+
+    def test_keep_incomplete_download(self):
+        self.server.truncate = 1000
+        self.assertRaises(IOError, self.download)
+        self.assertFalse(exists(self.file_path))
+        self.assertEqual(self.read(self.part_path), CONTENT[:-1000])
+
+
+if __name__ == '__main__':
+    unittest.main()
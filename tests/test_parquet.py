@@ -0,0 +1,102 @@
+"""Tests of the parquet loader of both scripts against the synthetic
+fixtures of the benchmark harness, run with:
+python -m unittest discover tests"""
+
+import shutil
+import tempfile
+import unittest
+from argparse import Namespace
+from os.path import exists, join
+
+from sqlalchemy import create_engine, MetaData
+
+import censuspgsql.postgis_tiger as tiger
+import censuspgsql.postgres_acs as acs
+from censuspgsql import benchmark
+from censuspgsql.utilities import ACS_MOD, ACS_SCHEMA, TIGER_MOD
+
+YEAR = 2099
+
+# the scripts are given an engine, but the parquet loader never connects
+PG_URL = 'postgresql://nobody@localhost/none'
+
+
+class ParquetRerunTest(unittest.TestCase):
+    """A rerun with fewer tables or products must only replace the
+    partitions of those it writes"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.data_dir = tempfile.mkdtemp()
+        options = Namespace(
+            seed=0, year=YEAR, span=5, states=['OR', 'WA'], sequences=2,
+            tables=2, cells=3, rows=5, products=['bg', 't'], features=5,
+            vertices=6)
+        benchmark.make_acs_fixtures(join(cls.data_dir, ACS_MOD), options)
+        benchmark.make_tiger_fixtures(join(cls.data_dir, TIGER_MOD), options)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.data_dir)
+
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def get_args(self, states):
+        return ['-y', str(YEAR), '-s'] + states + [
+            '-ld', 'parquet', '-od', self.output_dir, '-p', 'x', '-nm']
+
+    def write_acs(self, states, tables):
+        gv = acs.process_options(self.get_args(states) + ['-tb'] + tables)
+        gv.data_dir = join(self.data_dir, ACS_MOD)
+        gv.engine = create_engine(PG_URL)
+        gv.lookup_file = 'ACS_5yr_Seq_Table_Number_Lookup.txt'
+        gv.metadata = MetaData(
+            bind=gv.engine, schema=ACS_SCHEMA.format(yr=YEAR, span=5))
+        acs.gv = gv
+        acs.write_parquet_tables()
+
+    def write_tiger(self, states, products):
+        gv = tiger.process_options(
+            self.get_args(states) + ['-dp'] + products)
+        gv.data_dir = join(self.data_dir, TIGER_MOD)
+        gv.engine = create_engine(PG_URL)
+        gv.metadata = MetaData(
+            bind=gv.engine, schema='tiger{}'.format(YEAR))
+        tiger.gv = gv
+        tiger.download_tiger_data(shp_path_only=True)
+        tiger.write_parquet_tables()
+
+    def get_acs_path(self, table, state):
+        return join(self.output_dir, ACS_SCHEMA.format(yr=YEAR, span=5),
+                    table, 'stusab={}'.format(state))
+
+    def get_tiger_path(self, table, fips):
+        return join(self.output_dir, 'tiger{}'.format(YEAR), table,
+                    'statefp={}'.format(fips))
+
+    def test_acs_rerun_with_fewer_tables(self):
+        self.write_acs(['OR', 'WA'], ['B00001', 'B00002'])
+        self.write_acs(['OR'], ['B00001'])
+
+        for table in ('geoheader', 'b00001', 'b00002', 'b00002_moe'):
+            for state in ('OR', 'WA'):
+                self.assertTrue(exists(self.get_acs_path(table, state)))
+
+        self.assertFalse(exists(join(
+            self.output_dir, ACS_SCHEMA.format(yr=YEAR, span=5), 'b00003')))
+
+    def test_tiger_rerun_with_fewer_products(self):
+        self.write_tiger(['OR', 'WA'], ['bg', 't'])
+        self.write_tiger(['OR'], ['bg'])
+
+        for table in ('bg', 'tract'):
+            for fips in ('41', '53'):
+                self.assertTrue(exists(self.get_tiger_path(table, fips)))
+
+
+if __name__ == '__main__':
+    unittest.main()